@@ -0,0 +1,67 @@
+import copy
+import json
+import os
+
+
+# =========== Channels we track and sheets their stats go to ===========
+
+# The config is a JSON file (channels.json next to this module by default, or the path in CHANNELS_CONFIG):
+#
+#   "channels"                - list of channels, each with "channel_id" (TGStat channel id, e.g. "t.me/kleymedia")
+#                               and "sheet" (name of the Sheety project with "daily" and "results" tabs)
+#   "max_parallel_channels"   - how many channels are processed at the same time
+#   "tgstat_quota"            - max number of TGStat requests per run, shared by all channels (null for no limit)
+#   "stats_request_budget"    - max number of post stats requests per run of a channel (null for no limit).
+#                               A channel may set its own. Posts over the budget carry their previous stats forward
+#   "harvest_listing_stats"   - take post counters from the listing, when it has all of them, instead of requesting
+#                               them per post (false by default). A channel may set its own
+#   "sheety_writes_in_flight" - how many row updates to Sheety are sent at once (4 by default). A channel may set its own
+#   "sinks"                   - where post stats go, Sheety only by default (see sinks module). A channel may set its own
+
+DEFAULT_CONFIG = {
+    "max_parallel_channels": 4,
+    "tgstat_quota": None,
+    "stats_request_budget": None,
+    "harvest_listing_stats": False,
+    "sheety_writes_in_flight": 4,
+    "sinks": [
+        {
+            "type": "sheety",
+        },
+    ],
+    "channels": [
+        {
+            "channel_id": "t.me/kleymedia",
+            "sheet": "kleyStats",
+        },
+    ],
+}
+
+
+def load_config(path=None):
+
+    """
+    This function reads the config file and returns it as a dict. Missing settings are taken from DEFAULT_CONFIG.
+    If there's no config file at all, DEFAULT_CONFIG is returned.
+    """
+
+    path = path or os.environ.get("CHANNELS_CONFIG",
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), "channels.json"))
+
+    # A deep copy, so settings filled into channels never end up in DEFAULT_CONFIG itself
+    config = copy.deepcopy(DEFAULT_CONFIG)
+
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as config_file:
+            config.update(json.load(config_file))
+
+    for channel in config["channels"]:
+        if "channel_id" not in channel or "sheet" not in channel:
+            raise ValueError(f"Every channel needs a channel_id and a sheet, got: {channel}")
+
+        channel.setdefault("stats_request_budget", config["stats_request_budget"])
+        channel.setdefault("harvest_listing_stats", config["harvest_listing_stats"])
+        channel.setdefault("sinks", config["sinks"])
+        channel.setdefault("sheety_writes_in_flight", config["sheety_writes_in_flight"])
+
+    return config
@@ -0,0 +1,130 @@
+import datetime
+import os
+import time
+
+import config
+import dates
+import metrics
+import posts_getter
+import scheduler
+import sinks
+from transport import default_transport
+
+
+# =========== Daemon settings ===========
+
+# Seconds between two runs of the daily sync
+INTERVAL = int(os.environ.get("DAEMON_INTERVAL", 3600))
+
+# Every FULL_RESYNC_EVERY runs, remembered sheet state is dropped and every tab is read from Sheety again,
+# in case someone has edited a sheet by hand. The whole listing of every channel is requested again too,
+# so posts deleted from a channel leave its sheet (see StatCalculator.sync_daily_listing).
+FULL_RESYNC_EVERY = int(os.environ.get("DAEMON_FULL_RESYNC_EVERY", 24))
+
+
+# =========== Now we create a class that keeps the tracker running between syncs ===========
+class Daemon:
+
+    """
+    main.py starts from scratch every time: new connections, new caches, every tab read again.
+    The daemon is started once and runs every channel on its own schedule:
+    the daily sync every INTERVAL seconds, and the results sync once a day.
+
+    Between runs it keeps everything that's still valid: the transport with its open connections
+    and rate budgets, StatCalculator and its stats cache and listing store, and rows of every tab
+    as they were left after the last sync (see DataManager.keep_sheet_state).
+    """
+
+    def __init__(self, channels_config: dict, transport=None, interval=INTERVAL, full_resync_every=FULL_RESYNC_EVERY):
+
+        self.config = channels_config
+        self.transport = transport if transport is not None else default_transport
+        self.interval = interval
+        self.full_resync_every = full_resync_every
+
+        if self.config.get("tgstat_quota") is not None:
+            self.transport.rate_limiter.set_quota("api.tgstat.ru", self.config["tgstat_quota"])
+
+        # Everything a channel needs is built once, keyed by channel id
+        self.channels = {}
+        for channel in self.config["channels"]:
+            self.channels[channel["channel_id"]] = {
+                "stats_calculator": posts_getter.StatCalculator(channel_id=channel["channel_id"],
+                                                                transport=self.transport,
+                                                                incremental=True,
+                                                                stats_budget=channel.get("stats_request_budget"),
+                                                                harvest_listing=channel.get("harvest_listing_stats",
+                                                                                            False)),
+                "sinks": sinks.make_sinks(channel, transport=self.transport, keep_sheet_state=True),
+            }
+
+        self.runs = 0
+        self.last_results_day = None
+
+    def run_channel(self, channel: dict, sync_results: bool):
+
+        parts = self.channels[channel["channel_id"]]
+        stats_calculator = parts["stats_calculator"]
+        stats_calculator.clear_posts()
+
+        scheduler.sync_daily(stats_calculator, parts["sinks"])
+        if sync_results:
+            scheduler.sync_results(stats_calculator, parts["sinks"])
+
+    def run_once(self, now=None):
+
+        """
+        This method runs a single sync of every channel and returns a dict of channel ids that have failed,
+        mapped to their errors. The results tab is synced on the first run of every day.
+        """
+
+        now = now or datetime.datetime.today()
+
+        # Dates are recalculated on every run, or the daemon would keep using the day it was started on
+        dates.set_today(now)
+
+        # "tgstat_quota" is per run, so every run starts with the whole of it
+        self.transport.rate_limiter.reset_quotas()
+
+        # Reports cover a single run (see metrics module), so timings and counters start from zero
+        self.transport.metrics.reset()
+        self.transport.rate_limiter.reset_counters()
+
+        if self.runs % self.full_resync_every == 0:
+            for parts in self.channels.values():
+                parts["stats_calculator"].listing_store.expire()
+                for sink in parts["sinks"]:
+                    sink.forget_state()
+
+        sync_results = self.last_results_day != now.date()
+
+        failures = scheduler.run_on_pool(self.config, lambda channel: self.run_channel(channel, sync_results))
+
+        self.runs += 1
+        if sync_results and not failures:
+            self.last_results_day = now.date()
+
+        return failures
+
+    def run_forever(self):
+
+        """
+        This method runs a sync every self.interval seconds until the process is stopped.
+        A failed run doesn't stop the daemon: the failed channels are simply synced again on the next run.
+        """
+
+        while True:
+            started = time.monotonic()
+
+            failures = self.run_once()
+            if failures:
+                print(f"{len(failures)} channel(s) failed: {', '.join(failures)}")
+
+            # Reports of the last run stay in place until the next one ends, so they can be scraped between runs
+            metrics.write_reports(self.transport)
+
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    Daemon(config.load_config()).run_forever()
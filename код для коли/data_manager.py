@@ -1,128 +1,117 @@
-import requests
 # from dotenv import load_dotenv
-import datetime
 import os
-import time
+
+from sheet_sync import plan_sync, sheet_row, rows_after_sync
+from sheet_writer import SheetWriter, WRITES_IN_FLIGHT
+from transport import default_transport
+from dates import is_results_period
 
 # load_dotenv()
 
 
-# =========== Get today's date, month and year ===========
-today = datetime.datetime.today()
-today_month = today.month
-today_year = today.year
-
-# =========== Set current month's first day ===========
-start_of_month = datetime.datetime(year=today_year,
-                                   month=today_month,
-                                   day=1)
-print(f"start_of_month: {start_of_month}")
-
-# =========== Set current month's last day ===========
-
-# Here we're getting the last day of prev month. We don't know what it is or if it's a leap year,
-# so we need to check four possible last dates: 31st, 30th, 29th and 28th.
-
-try:
-    end_of_month = datetime.datetime(year=today_year,
-                                     month=today_month,
-                                     day=31,
-                                     hour=23,
-                                     minute=59,
-                                     second=59)
-except ValueError:
-    try:
-        end_of_month = datetime.datetime(year=today_year,
-                                         month=today_month,
-                                         day=30,
-                                         hour=23,
-                                         minute=59,
-                                         second=59)
-    except ValueError:
-        try:
-            end_of_month = datetime.datetime(year=today_year,
-                                             month=today_month,
-                                             day=29,
-                                             hour=23,
-                                             minute=59,
-                                             second=59)
-        except ValueError:
-            end_of_month = datetime.datetime(year=today_year,
-                                             month=today_month,
-                                             day=28,
-                                             hour=23,
-                                             minute=59,
-                                             second=59)
-
-print(f"end of month: {end_of_month}")
-
-
-# =========== We'll also need dates of start and end of previous month ===========
-
-# Here we're getting the start of prev month. If it's January, we can't just subtract, so we set the date manually
-if today.month == 1:
-    prev_year = (today - datetime.timedelta(days=35)).year
-    start_of_prev_month = datetime.datetime(year=prev_year,
-                                            month=12,
-                                            day=1)
-
-# If it's not January, we can just subtract one from month number
-else:
-    start_of_prev_month = datetime.datetime(year=today.year,
-                                            month=today.month - 1,
-                                            day=1)
-
-start_of_prev_month_unix = time.mktime(start_of_prev_month.timetuple())
-
-
-# Here we're getting the last day of prev month. We don't know what it is or if it's a leap year,
-# so we need to check four possible last dates: 31st, 30th, 29th and 28th.
-
-try:
-    end_of_prev_month = datetime.datetime(year=start_of_prev_month.year,
-                                          month=start_of_prev_month.month,
-                                          day=31,
-                                          hour=23,
-                                          minute=59,
-                                          second=59)
-except ValueError:
-    try:
-        end_of_prev_month = datetime.datetime(year=start_of_prev_month.year,
-                                              month=start_of_prev_month.month,
-                                              day=30,
-                                              hour=23,
-                                              minute=59,
-                                              second=59)
-    except ValueError:
-        try:
-            end_of_prev_month = datetime.datetime(year=start_of_prev_month.year,
-                                                  month=start_of_prev_month.month,
-                                                  day=29,
-                                                  hour=23,
-                                                  minute=59,
-                                                  second=59)
-        except ValueError:
-            end_of_prev_month = datetime.datetime(year=start_of_prev_month.year,
-                                                  month=start_of_prev_month.month,
-                                                  day=28,
-                                                  hour=23,
-                                                  minute=59,
-                                                  second=59)
-
-end_of_prev_month_unix = time.mktime(end_of_prev_month.timetuple())
+# Sheety wraps every row we write in an object named after the tab in singular
+ROW_KEYS = {
+    "daily": "daily",
+    "results": "result",
+}
 
 
 # =========== Now we create a class that allows us to get, write, update and delete data in a Google sheet ===========
 class DataManager:
 
-    def __init__(self, post_stats):
+    def __init__(self, post_stats, transport=None, sheet="kleyStats", keep_sheet_state=False,
+                 writes_in_flight=WRITES_IN_FLIGHT):
 
         self.post_stats = post_stats
-        self.sheety_endpoint = f"https://api.sheety.co/{os.environ["SHEETY_USERNAME"]}/kleyStats"
+        self.transport = transport if transport is not None else default_transport
+        self.sheety_endpoint = f"https://api.sheety.co/{os.environ["SHEETY_USERNAME"]}/{sheet}"
         self.headers = {
             "Authorization": f"Bearer {os.environ["SHEETY_TOKEN"]}"
         }
 
+        # A long-running process remembers what a tab holds after it has synced it, so the next sync of that tab
+        # doesn't have to read it again. Rows are forgotten as soon as the tab starts changing,
+        # so if anything fails halfway through, the tab is read from Sheety next time.
+        self.keep_sheet_state = keep_sheet_state
+        self.known_rows = {}
+
+        # Updates of different rows are sent several at a time (see sheet_writer module)
+        self.writer = SheetWriter(self, writes_in_flight)
+
+    def send(self, method: str, url: str, **kwargs):
+
+        """
+        This method makes a request to Sheety through the shared transport, which keeps connections alive,
+        paces requests to every tab, slows down and retries if Sheety is overloaded
+        (see transport and rate_limiter modules).
+        """
+
+        return self.transport.request(method, url, headers=self.headers, **kwargs)
+
+    def read_rows(self, tab: str):
+
+        """
+        This method reads every row of a tab ("daily" or "results") and returns them as a list of dicts.
+        If we remember what the tab holds, Sheety isn't called.
+        """
+
+        if tab in self.known_rows:
+            return self.known_rows[tab]
+
+        response = self.send("GET", f"{self.sheety_endpoint}/{tab}")
+        response.raise_for_status()
+        return response.json()[tab]
+
+    def write_row(self, tab: str, post, row_id=None):
+
+        """
+        This method writes a Post to a tab. If row_id is given, that row is overwritten via PUT request,
+        else the post is added to the end of the tab via POST request.
+        """
+
+        config = {
+            ROW_KEYS[tab]: sheet_row(post)
+        }
+
+        if row_id is None:
+            response = self.send("POST", f"{self.sheety_endpoint}/{tab}", json=config)
+        else:
+            response = self.send("PUT", f"{self.sheety_endpoint}/{tab}/{row_id}", json=config)
+
+        response.raise_for_status()
+        return response
+
+    def delete_row(self, tab: str, row_id: int):
+        response = self.send("DELETE", f"{self.sheety_endpoint}/{tab}/{row_id}")
+        response.raise_for_status()
+
+    def apply_plan(self, tab: str, plan):
+
+        """
+        This method makes the requests a SyncPlan calls for (see sheet_sync module).
+        """
+
+        # Step 1: Delete rows bottom-up, so ids of rows that are still to be deleted never change
+
+        for row_id in plan.deletes:
+            self.delete_row(tab, row_id)
+
+        # Step 2: Update rows whose values have changed.
+        # Rows don't move any more, so they're written several at a time.
+
+        self.writer.update_rows(tab, {id_: self.post_stats[post_url] for id_, post_url in plan.updates.items()})
+
+        # Step 3: Add rows with new posts, in chronological order
+
+        self.writer.insert_rows(tab, [self.post_stats[post_link] for post_link in plan.inserts])
+
+    def forget_rows(self, tab: str):
+        self.known_rows.pop(tab, None)
+
+    def remember_rows(self, tab: str, rows: list):
+        if self.keep_sheet_state:
+            self.known_rows[tab] = rows
+
     def first_call_daily_sheet(self):
 
         """
@@ -132,26 +121,12 @@ class DataManager:
         Else, the method will escape.
         """
 
-        response = requests.get(url=f"{self.sheety_endpoint}/daily", headers=self.headers)
-        response.raise_for_status()
-
-        if not response.json()["daily"]:
+        if not self.read_rows("daily"):
             # If there's no data, the method takes posts from it's "post_stats" attribute and
             # fills the table with their data.
-            for post_link, post_data in self.post_stats.items():
-                config = {
-                    "daily": {
-                        "postPreview": post_data["text"],
-                        "postUrl": post_link,
-                        "postDate": post_data["date"].strftime("%d.%m.%y"),
-                        "sharesPerView": post_data["shares_per_view"],
-                        "reactionsPerView": post_data["reactions_per_view"],
-                    }
-                }
-                post_response = requests.post(url=f"{self.sheety_endpoint}/daily", json=config, headers=self.headers)
-                post_response.raise_for_status()
-                print(post_response.text)
-                time.sleep(0.5)
+            self.forget_rows("daily")
+
+            self.writer.insert_rows("daily", list(self.post_stats.values()))
 
         else:
             # If there is data, the method escapes.
@@ -166,39 +141,17 @@ class DataManager:
         Else, the method will escape.
         """
 
-        response = requests.get(url=f"{self.sheety_endpoint}/results", headers=self.headers)
+        response = self.send("GET", f"{self.sheety_endpoint}/results")
         response.raise_for_status()
 
         if not response.json()["results"]:
             # If there's no data
 
-            if datetime.datetime(year=today_year,
-                                 month=today_month,
-                                 day=14) <= today <= datetime.datetime(year=today_year,
-                                                                       month=today_month,
-                                                                       day=16,
-                                                                       hour=23,
-                                                                       minute=59,
-                                                                       second=59):
+            if is_results_period():
                 # and if today's date is 14th, 15th or 16th,
                 # the method takes posts from it's "post_stats" attribute and fills the table with their data.
 
-                for post_link, post_data in self.post_stats.items():
-                    config = {
-                        "result": {
-                            "postPreview": post_data["text"],
-                            "postUrl": post_link,
-                            "postDate": post_data["date"].strftime("%d.%m.%y"),
-                            "sharesPerView": post_data["shares_per_view"],
-                            "reactionsPerView": post_data["reactions_per_view"],
-                        }
-                    }
-                    post_response = requests.post(url=f"{self.sheety_endpoint}/results",
-                                                  json=config,
-                                                  headers=self.headers)
-                    post_response.raise_for_status()
-                    print(post_response.text)
-                    time.sleep(0.5)
+                self.writer.insert_rows("results", list(self.post_stats.values()))
 
             else:
                 # If there's no data but the date is not 14th, 15th or 16th,
@@ -213,107 +166,102 @@ class DataManager:
                         "reactionsPerView": "🤙🤙🤙",
                     }
                 }
-                post_response = requests.post(url=f"{self.sheety_endpoint}/results", json=config, headers=self.headers)
+                post_response = self.send("POST", f"{self.sheety_endpoint}/results", json=config)
                 post_response.raise_for_status()
 
         else:
             # If there is data, the method escapes.
             return
 
-    def update_daily(self):
+    def plan_daily(self):
 
         """
-        This method reads data from "daily" sheet and updates it. If there's no data, the method escapes.
+        This method is a dry run of first_call_daily_sheet and update_daily: it reads "daily" sheet and returns
+        the requests the two would make to that tab, as a dict of methods mapped to numbers of requests.
+        Nothing is written to the sheet.
 
-        Post are updated following the logic:
+        Posts with no ratios yet (see StatCalculator.plan_posts_stats) are counted as updated.
+        """
 
-        1. The method finds outdated posts by looking for links that are in the sheet, but
-        not in the "post_stats" attribute. These links are older than one month,
-        so the rows, containing them, should be deleted via DELETE request.
+        table_rows = self.read_rows("daily")
 
-        2. After deletion, the method finds posts that need to be updated via PUT request
-        by looking for links that are in the sheet and in the "post_stats" attribute.
+        # Both methods read the tab, unless we remember what it holds
+        reads = 0 if "daily" in self.known_rows else 2
 
-        3. In the end the method finds new posts by looking for links that are not in the sheet,
-        but in the "post_stats" attribute. These posts should be added to sheet via POST request.
+        if not table_rows:
+            return {"GET": reads, "POST": len(self.post_stats)}
+
+        plan = plan_sync(table_rows, self.post_stats)
+
+        return {"GET": reads, "DELETE": len(plan.deletes), "PUT": len(plan.updates), "POST": len(plan.inserts)}
+
+    def plan_results(self):
+
+        """
+        This method is a dry run of first_call_results_sheet and update_results: it reads "results" sheet
+        and returns the requests the two would make to that tab, as a dict of methods mapped to numbers of requests.
+        Nothing is written to the sheet.
         """
 
-        response = requests.get(url=f"{self.sheety_endpoint}/daily", headers=self.headers)
+        response = self.send("GET", f"{self.sheety_endpoint}/results")
         response.raise_for_status()
+        table_rows = response.json()["results"]
 
-        if not response.json()["daily"]:
-            return
+        if is_results_period():
+            if not table_rows:
+                return {"GET": 2, "POST": len(self.post_stats or {})}
 
-        else:
+            plan = plan_sync(table_rows, self.post_stats or {})
+            return {"GET": 2, "DELETE": len(plan.deletes), "PUT": len(plan.updates), "POST": len(plan.inserts)}
+
+        # On any other day the sheet gets a placeholder, unless it already has one
+        if not table_rows:
+            return {"GET": 2, "POST": 1}
 
-            # Step 1: Check what post from table are not in the response from API.
+        if table_rows[0]["postPreview"] != "постики":
+            return {"GET": 2, "DELETE": len(table_rows), "POST": 1}
 
-            table_post_links_and_ids = {row["postUrl"]: row["id"] for row in response.json()["daily"]}
+        return {"GET": 2}
+
+    def update_daily(self):
 
-            rows_to_clear = [row_id for url, row_id in table_post_links_and_ids.items() if url not in self.post_stats]
+        """
+        This method reads data from "daily" sheet and updates it. If there's no data, the method escapes.
 
-            for i in range(len(rows_to_clear)):
+        Post are updated following the logic:
 
-                resp = requests.get(url=f"{self.sheety_endpoint}/daily", headers=self.headers)
-                table_data = {row["postUrl"]: row["id"] for row in resp.json()["daily"]}
+        1. The method finds outdated posts by looking for links that are in the sheet, but
+        not in the "post_stats" attribute. These links are older than one month,
+        so the rows, containing them, should be deleted via DELETE request.
 
-                actual_rows_to_clear = [row_id for url, row_id in table_data.items() if url not in self.post_stats]
+        2. The method finds posts that need to be updated via PUT request
+        by looking for links that are in the sheet and in the "post_stats" attribute.
+        Rows that already hold the same values are skipped.
+        Their row ids after deletion are calculated locally, the sheet is not read again.
+        If a link is in more than one row (left by a sync that has failed halfway), only the first row is kept.
+        Rows that hold another post than they should (also left by a failed sync) are rewritten,
+        so posts stay in chronological order (see plan_sync in sheet_sync module).
 
-                del_response = requests.delete(url=f"{self.sheety_endpoint}/daily/{actual_rows_to_clear[0]}",
-                                               headers=self.headers)
-                del_response.raise_for_status()
+        3. In the end the method finds new posts by looking for links that are not in the sheet,
+        but in the "post_stats" attribute. These posts should be added to sheet via POST request.
+        """
 
-                time.sleep(0.5)
+        table_rows = self.read_rows("daily")
 
-            # Step 2: Update posts, that are in both dictionaries
+        if not table_rows:
+            return
 
-            response_after_del = requests.get(url=f"{self.sheety_endpoint}/daily", headers=self.headers)
-            response_after_del.raise_for_status()
+        else:
 
-            table_post_links_and_ids_after_del = {row["postUrl"]: row["id"] for row
-                                                  in response_after_del.json()["daily"]}
-            rows_to_update = {row_id: url for url, row_id
-                              in table_post_links_and_ids_after_del.items()
-                              if url in self.post_stats}
-            for id_, post_url in rows_to_update.items():
+            # The sheet is read only once. All three steps are planned upfront,
+            # and row ids shifted by deletions are worked out locally (see sheet_sync module).
 
-                put_config = {
-                    "daily": {
-                        "postPreview": self.post_stats[post_url]["text"],
-                        "postUrl": post_url,
-                        "postDate": self.post_stats[post_url]["date"].strftime("%d.%m.%y"),
-                        "sharesPerView": self.post_stats[post_url]["shares_per_view"],
-                        "reactionsPerView": self.post_stats[post_url]["reactions_per_view"],
-                    }
-                }
+            plan = plan_sync(table_rows, self.post_stats)
+            print(f"daily sync: {plan}")
 
-                put_response = requests.put(url=f"{self.sheety_endpoint}/daily/{id_}",
-                                            json=put_config,
-                                            headers=self.headers)
-                put_response.raise_for_status()
-                time.sleep(0.5)
-
-            # Step 3: Add rows with new posts
-
-            posts_to_add = [link for link, post_data
-                            in self.post_stats.items()
-                            if link not in table_post_links_and_ids_after_del]
-            for post_link in posts_to_add:
-
-                post_config = {
-                    "daily": {
-                        "postPreview": self.post_stats[post_link]["text"],
-                        "postUrl": post_link,
-                        "postDate": self.post_stats[post_link]["date"].strftime("%d.%m.%y"),
-                        "sharesPerView": self.post_stats[post_link]["shares_per_view"],
-                        "reactionsPerView": self.post_stats[post_link]["reactions_per_view"],
-                    }
-                }
-                post_response = requests.post(url=f"{self.sheety_endpoint}/daily",
-                                              json=post_config,
-                                              headers=self.headers)
-                post_response.raise_for_status()
-                time.sleep(0.5)
+            self.forget_rows("daily")
+            self.apply_plan("daily", plan)
+            self.remember_rows("daily", rows_after_sync(self.post_stats))
 
     def update_results(self):
 
@@ -324,70 +272,32 @@ class DataManager:
 
         1. If today's date is not 14th, 15th or 16th, the method deletes all rows in the sheet and writes a placeholder
 
-        2. Else, the method checks for placeholder. If it finds it, it deletes the placeholder and
-        fills the sheet with data on posts dated from start to end of previous month.
+        2. Else, the sheet is synced with posts dated from start to end of previous month, just like "daily" sheet:
+        the placeholder and rows that don't belong there are deleted, rows whose values have changed are updated
+        via PUT request, and posts that are missing are added. Unchanged rows are skipped.
 
-        3. If there's no placeholder, then there's data in the sheet, thus it needs to be updated via PUT request.
+        So whatever state a failed run has left the sheet in (the placeholder gone but only some of the posts
+        added, or a post added twice), the next run brings it to the same rows in chronological order.
         """
 
-        response = requests.get(url=f"{self.sheety_endpoint}/results", headers=self.headers)
+        response = self.send("GET", f"{self.sheety_endpoint}/results")
         response.raise_for_status()
-        print(response.json())
-
-        if datetime.datetime(year=today_year,
-                             month=today_month,
-                             day=14) <= today <= datetime.datetime(year=today_year,
-                                                                   month=today_month,
-                                                                   day=16,
-                                                                   hour=23,
-                                                                   minute=59,
-                                                                   second=59):
-
-            if response.json()["results"][0]["postPreview"] == "постики":
-                del_response = requests.delete(url=f"{self.sheety_endpoint}/results/2", headers=self.headers)
-                del_response.raise_for_status()
-
-                for post_url, post_data in self.post_stats.items():
-                    post_config = {
-                        "result": {
-                                "postPreview": post_data["text"],
-                                "postUrl": post_url,
-                                "postDate": post_data["date"].strftime("%d.%m.%y"),
-                                "sharesPerView": post_data["shares_per_view"],
-                                "reactionsPerView": post_data["reactions_per_view"],
-                            }
-                    }
-
-                    post_response = requests.post(url=f"{self.sheety_endpoint}/results",
-                                                  json=post_config,
-                                                  headers=self.headers)
-                    post_response.raise_for_status()
-                    time.sleep(0.5)
+        table_rows = response.json()["results"]
 
-            else:
+        if is_results_period():
 
-                table_post_links_and_ids = {row["postUrl"]: row["id"] for row in response.json()["results"]}
-
-                for post_url, row_id in table_post_links_and_ids.items():
-                    put_config = {
-                        "result": {
-                            "sharesPerView": self.post_stats[f"{post_url}"]["shares_per_view"],
-                            "reactionsPerView": self.post_stats[f"{post_url}"]["reactions_per_view"],
-                        }
-                    }
+            # The placeholder is just another row that's not in post stats, so it's deleted along with the rest
+            plan = plan_sync(table_rows, self.post_stats)
+            print(f"results sync: {plan}")
 
-                    put_response = requests.put(url=f"{self.sheety_endpoint}/results/{row_id}",
-                                                json=put_config,
-                                                headers=self.headers)
-                    put_response.raise_for_status()
-                    time.sleep(0.5)
+            self.apply_plan("results", plan)
 
         else:
 
-            if response.json()["results"][0]["postPreview"] != "постики":
+            if table_rows[0]["postPreview"] != "постики":
 
-                for i in range(len(response.json()["results"])):
-                    del_resp = requests.delete(url=f"{self.sheety_endpoint}/results/2", headers=self.headers)
+                for i in range(len(table_rows)):
+                    del_resp = self.send("DELETE", f"{self.sheety_endpoint}/results/2")
                     del_resp.raise_for_status()
 
                 post_cfg = {
@@ -400,5 +310,5 @@ class DataManager:
                     }
                 }
 
-                pst_response = requests.post(url=f"{self.sheety_endpoint}/results", json=post_cfg, headers=self.headers)
+                pst_response = self.send("POST", f"{self.sheety_endpoint}/results", json=post_cfg)
                 pst_response.raise_for_status()
@@ -0,0 +1,96 @@
+import datetime as dt
+import time
+
+
+# =========== Dates we need are calculated from today's date ===========
+def set_today(now=None):
+
+    """
+    This function calculates every date the tracker needs from today's date (or from "now", if it's given).
+    It runs on import, and a long-running process calls it again before every run, so the dates don't go stale.
+
+    Every module reads the dates from here (e.g. dates.today_unix), so they all work with the same day.
+    """
+
+    global today, today_unix, a_month_ago, a_month_ago_unix
+    global start_of_prev_month, start_of_prev_month_unix, end_of_prev_month, end_of_prev_month_unix
+
+    # =========== Get today's date ===========
+    today = now or dt.datetime.today()  # dt.datetime(year=2024, month=10, day=16, hour=10)
+    today_unix = time.mktime(today.timetuple())
+
+    # =========== Calculate which date it was a month ago ===========
+    a_month_ago = today - dt.timedelta(days=31)
+    a_month_ago_unix = time.mktime(a_month_ago.timetuple())
+
+    # =========== We'll need dates of start and end of previous month ===========
+
+    # Here we're getting the start of prev month. If it's January, we can't just subtract, so we set the date manually
+    if today.month == 1:
+        prev_year = (today - dt.timedelta(days=35)).year
+        start_of_prev_month = dt.datetime(year=prev_year,
+                                          month=12,
+                                          day=1)
+
+    # If it's not January, we can just subtract one from month number
+    else:
+        start_of_prev_month = dt.datetime(year=today.year,
+                                          month=today.month - 1,
+                                          day=1)
+
+    start_of_prev_month_unix = time.mktime(start_of_prev_month.timetuple())
+
+    # Here we're getting the last day of prev month. We don't know what it is or if it's a leap year,
+    # so we need to check four possible last dates: 31st, 30th, 29th and 28th.
+
+    try:
+        end_of_prev_month = dt.datetime(year=start_of_prev_month.year,
+                                        month=start_of_prev_month.month,
+                                        day=31,
+                                        hour=23,
+                                        minute=59,
+                                        second=59)
+    except ValueError:
+        try:
+            end_of_prev_month = dt.datetime(year=start_of_prev_month.year,
+                                            month=start_of_prev_month.month,
+                                            day=30,
+                                            hour=23,
+                                            minute=59,
+                                            second=59)
+        except ValueError:
+            try:
+                end_of_prev_month = dt.datetime(year=start_of_prev_month.year,
+                                                month=start_of_prev_month.month,
+                                                day=29,
+                                                hour=23,
+                                                minute=59,
+                                                second=59)
+            except ValueError:
+                end_of_prev_month = dt.datetime(year=start_of_prev_month.year,
+                                                month=start_of_prev_month.month,
+                                                day=28,
+                                                hour=23,
+                                                minute=59,
+                                                second=59)
+
+    end_of_prev_month_unix = time.mktime(end_of_prev_month.timetuple())
+
+
+set_today()
+
+
+def is_results_period():
+
+    """
+    Monthly results are published on 14th, 15th and 16th. This function checks if today is one of those days.
+    """
+
+    return dt.datetime(year=today.year,
+                       month=today.month,
+                       day=14) <= today <= dt.datetime(year=today.year,
+                                                       month=today.month,
+                                                       day=16,
+                                                       hour=23,
+                                                       minute=59,
+                                                       second=59)
@@ -0,0 +1,271 @@
+import json
+import os
+
+import config
+import data_manager
+import metrics
+import posts_getter
+import recording
+import sinks
+from rate_limiter import endpoint_key
+from sheet_writer import WRITES_IN_FLIGHT
+
+
+# =========== Dry run settings ===========
+
+# Round trip of a single request, in seconds, to a service the dry run hasn't called itself
+DEFAULT_ROUND_TRIP = 0.5
+
+# The plan is printed, and also written as JSON to DRY_RUN_REPORT, if it's set
+
+
+def pacing_seconds(count: int, budget: tuple):
+
+    """
+    This function returns how long the rate limiter takes to let count requests to an endpoint through, in seconds,
+    if every response is healthy: the first one goes right away, the next ones are spaced at the starting rate
+    of the budget, which grows by a tenth with every response up to the max rate
+    (see TokenBucket in rate_limiter module).
+    """
+
+    rate, max_rate = budget
+    rate_step = rate / 10
+    seconds = 0.0
+
+    for _ in range(count - 1):
+        seconds += 1 / rate
+        rate = min(max_rate, rate + rate_step)
+
+    return seconds
+
+
+def duration_text(seconds: float):
+
+    """
+    This function turns a number of seconds into a short text, e.g. "1 h 5 min", "3 min 20 s" or "12 s".
+    """
+
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours:
+        return f"{hours} h {minutes} min"
+    if minutes:
+        return f"{minutes} min {seconds} s"
+    return f"{seconds} s"
+
+
+# =========== Now we create a class that holds every request a run of a channel would make ===========
+class ChannelPlan:
+
+    def __init__(self, channel_id: str):
+
+        self.channel_id = channel_id
+
+        # Endpoint keys (see endpoint_key in rate_limiter module) mapped to dicts of methods and numbers of requests
+        self.requests = {}
+
+        # (endpoint key, method) mapped to how many of those requests are in flight at once
+        self.in_flight = {}
+
+    def add(self, url: str, method: str, count: int, in_flight=1):
+
+        if not count:
+            return
+
+        key = endpoint_key(url)
+
+        methods = self.requests.setdefault(key, {})
+        methods[method] = methods.get(method, 0) + count
+        self.in_flight[(key, method)] = in_flight
+
+    def estimate(self, rate_limiter, round_trips: dict):
+
+        """
+        This method estimates how long the run of the channel would take and how much of that is spent sleeping
+        in the rate limiter, in seconds. round_trips maps hosts to seconds a single request takes.
+
+        Steps of a run go one after another, so every endpoint adds the longer of two times: how long its budget
+        takes to let every request through, and how long responses take to arrive with its requests in flight.
+        """
+
+        seconds = 0.0
+        slept = 0.0
+
+        for key, methods in self.requests.items():
+            round_trip = round_trips.get(key.split("/", 1)[0], DEFAULT_ROUND_TRIP)
+
+            pacing = pacing_seconds(sum(methods.values()), rate_limiter.budget(key))
+            waiting = sum(count * round_trip / self.in_flight[(key, method)] for method, count in methods.items())
+
+            seconds += max(pacing, waiting)
+            slept += max(0.0, pacing - waiting)
+
+        return seconds, slept
+
+
+def plan_channel(channel: dict, transport):
+
+    """
+    This function works out every request a run of a channel would make, without making any of those that
+    cost anything or change anything: the listing and the sheet are read, post stats are not requested
+    (the stats cache and the budget tell which ones would be), and nothing is written to the sheet.
+
+    The listing is planned the way the first run of a channel gets it, the whole window at once:
+    a channel whose listing is already stored (see StatCalculator.sync_daily_listing) needs fewer calls.
+    """
+
+    stats_calculator = posts_getter.StatCalculator(channel_id=channel["channel_id"],
+                                                   transport=transport,
+                                                   stats_budget=channel.get("stats_request_budget"),
+                                                   harvest_listing=channel.get("harvest_listing_stats", False))
+    plan = ChannelPlan(channel["channel_id"])
+
+    # The listing is actually requested, it's the only way to know which posts there are.
+    # Its calls are counted by the transport's metrics.
+    listed_before = transport.metrics.report()["endpoints"]
+
+    daily_posts, monthly_posts = stats_calculator.get_daily_and_monthly_posts_data()
+
+    if daily_posts is None or monthly_posts is None:
+        raise posts_getter.ListingError(f"Couldn't get posts of {channel['channel_id']}")
+
+    for key, counters in transport.metrics.report()["endpoints"].items():
+        if key.startswith("api.tgstat.ru"):
+            plan.add(f"https://{key}", "GET", counters["requests"] - listed_before.get(key, {}).get("requests", 0),
+                     in_flight=stats_calculator.max_workers)
+
+    # Text is cut just like in a run, so rows are compared with the sheet the same way
+    stats_calculator.cut_text(stats_calculator.daily_posts)
+    stats_calculator.order_post_chronologically("daily")
+    stats_calculator.cut_text(stats_calculator.monthly_posts)
+    stats_calculator.order_post_chronologically("monthly")
+
+    daily_stats, daily_fetches = stats_calculator.plan_posts_stats(stats_calculator.daily_posts)
+    results_stats, results_fetches = stats_calculator.plan_posts_stats(stats_calculator.monthly_posts,
+                                                                       planned_links=daily_fetches)
+
+    plan.add(stats_calculator.posts_stats_endpoint, "GET", len(daily_fetches) + len(results_fetches),
+             in_flight=stats_calculator.max_workers)
+
+    if any(sink_config["type"] == "sheety" for sink_config in channel.get("sinks") or sinks.DEFAULT_SINKS):
+        manager = data_manager.DataManager(daily_stats, transport=transport, sheet=channel["sheet"])
+        writes_in_flight = channel.get("sheety_writes_in_flight", WRITES_IN_FLIGHT)
+
+        for tab, post_stats, plan_tab in (("daily", daily_stats, manager.plan_daily),
+                                          ("results", results_stats, manager.plan_results)):
+            manager.post_stats = post_stats
+
+            for method, count in plan_tab().items():
+                plan.add(f"{manager.sheety_endpoint}/{tab}", method, count,
+                         in_flight=writes_in_flight if method == "PUT" else 1)
+
+    return plan
+
+
+def masked(requests: dict):
+
+    """
+    This function returns requests by endpoint with the Sheety username in endpoint keys replaced by its name,
+    so the plan can be shared.
+    """
+
+    username = os.environ.get("SHEETY_USERNAME")
+
+    if not username:
+        return dict(requests)
+
+    return {key.replace(f"/{username}/", "/SHEETY_USERNAME/"): methods for key, methods in requests.items()}
+
+
+def round_trips(run_metrics):
+
+    """
+    This function returns the average round trip of requests the dry run has made, in seconds, by host.
+    """
+
+    totals = {}
+
+    for key, counters in run_metrics.report()["endpoints"].items():
+        requests, seconds = totals.get(key.split("/", 1)[0], (0, 0.0))
+        totals[key.split("/", 1)[0]] = (requests + counters["requests"], seconds + counters["seconds"])
+
+    return {host: seconds / requests for host, (requests, seconds) in totals.items() if requests}
+
+
+def plan_run(channels_config: dict, transport):
+
+    """
+    This function plans a run of every channel from the config and returns the plan as a dict:
+    requests of every channel and of the whole run by endpoint and method, TGStat requests against the quota,
+    and estimated durations in seconds.
+
+    Channels are planned one by one. The whole run is estimated with "max_parallel_channels" channels at a time,
+    but no faster than the budget of any endpoint shared by several channels lets their requests through.
+    """
+
+    plans = [plan_channel(channel, transport) for channel in channels_config["channels"]]
+    measured_round_trips = round_trips(transport.metrics)
+    rate_limiter = transport.rate_limiter
+
+    channels = {}
+    run_requests = {}
+
+    for plan in plans:
+        seconds, slept = plan.estimate(rate_limiter, measured_round_trips)
+        channels[plan.channel_id] = {"requests": masked(plan.requests), "seconds": seconds, "slept_seconds": slept}
+
+        for key, methods in plan.requests.items():
+            for method, count in methods.items():
+                run_requests.setdefault(key, {})
+                run_requests[key][method] = run_requests[key].get(method, 0) + count
+
+    channel_seconds = [channel["seconds"] for channel in channels.values()] or [0.0]
+    shared_pacing = [pacing_seconds(sum(methods.values()), rate_limiter.budget(key))
+                     for key, methods in run_requests.items()]
+
+    tgstat_requests = sum(count for key, methods in run_requests.items() if key.startswith("api.tgstat.ru")
+                          for count in methods.values())
+
+    return {
+        "channels": channels,
+        "requests": masked(run_requests),
+        "total_requests": sum(count for methods in run_requests.values() for count in methods.values()),
+        "tgstat_requests": tgstat_requests,
+        "tgstat_quota": channels_config.get("tgstat_quota"),
+        "seconds": max(sum(channel_seconds) / channels_config["max_parallel_channels"],
+                       max(channel_seconds),
+                       *shared_pacing),
+        "round_trips": measured_round_trips,
+    }
+
+
+def print_plan(run_plan: dict):
+
+    def print_requests(requests: dict):
+        for key, methods in sorted(requests.items()):
+            print(f"    {key}: " + ", ".join(f"{method} {count}" for method, count in sorted(methods.items())))
+
+    for channel_id, channel in run_plan["channels"].items():
+        print(f"{channel_id}: {sum(sum(methods.values()) for methods in channel['requests'].values())} requests, "
+              f"about {duration_text(channel['seconds'])} "
+              f"({duration_text(channel['slept_seconds'])} of them waiting for the rate limiter)")
+        print_requests(channel["requests"])
+
+    print(f"Whole run: {run_plan['total_requests']} requests, about {duration_text(run_plan['seconds'])}")
+    print_requests(run_plan["requests"])
+
+    if run_plan["tgstat_quota"] is not None and run_plan["tgstat_requests"] > run_plan["tgstat_quota"]:
+        print(f"TGStat quota is {run_plan['tgstat_quota']} requests, the run needs {run_plan['tgstat_requests']}")
+
+
+if __name__ == "__main__":
+    dry_run_transport = recording.transport_from_env()
+
+    plan = plan_run(config.load_config(), dry_run_transport)
+    print_plan(plan)
+
+    if os.environ.get("DRY_RUN_REPORT"):
+        metrics.write_atomically(os.environ["DRY_RUN_REPORT"], json.dumps(plan, ensure_ascii=False, indent=2))
+
+    dry_run_transport.close()
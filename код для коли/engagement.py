@@ -0,0 +1,170 @@
+import numpy as np
+
+
+# =========== Engagement metrics of many posts at once ===========
+
+# Median absolute deviation of normally distributed values is this many times smaller than their standard deviation
+MAD_TO_STD = 1.4826
+
+
+def ratios(counts: np.ndarray, views: np.ndarray):
+
+    """
+    This function returns counts per view in percent, rounded to two decimals, for arrays of posts.
+    Posts with no views get 0 instead of a division by zero.
+    """
+
+    per_view = np.zeros(len(views), dtype=float)
+    np.divide(counts, views, out=per_view, where=views > 0)
+
+    return np.round(per_view * 100, 2)
+
+
+def percentile_ranks(values: np.ndarray):
+
+    """
+    This function returns the percentile rank of every value: the share of values that are less than
+    or equal to it, in percent. The best post of a channel gets 100.
+    """
+
+    if len(values) == 0:
+        return np.zeros(0)
+
+    sorted_values = np.sort(values)
+    return np.searchsorted(sorted_values, values, side="right") / len(values) * 100
+
+
+def z_scores(values: np.ndarray):
+
+    """
+    This function returns how far every value is from the median, in robust standard deviations
+    (median absolute deviation scaled to a standard deviation). A few viral posts don't skew it the way they skew
+    the mean. If most values are equal and the deviation is 0, the usual standard deviation is used instead,
+    and if that's 0 too, every value gets 0.
+    """
+
+    if len(values) == 0:
+        return np.zeros(0)
+
+    median = np.median(values)
+    spread = MAD_TO_STD * np.median(np.abs(values - median))
+
+    if spread == 0:
+        spread = np.std(values)
+    if spread == 0:
+        return np.zeros(len(values))
+
+    return (values - median) / spread
+
+
+# =========== Now we create a class that holds engagement metrics of a set of posts ===========
+class EngagementTable:
+
+    """
+    Metrics of every post are kept in arrays, one element per post, so every metric is calculated
+    for the whole set in a single batch instead of a Python loop per post.
+
+    Rankings (percentile ranks, z-scores, top lists) are calculated within every channel.
+    """
+
+    def __init__(self, links: list, shares_per_view, reactions_per_view, channel_ids=None):
+
+        self.links = np.asarray(links, dtype=object)
+        self.shares_per_view = np.asarray(shares_per_view, dtype=float)
+        self.reactions_per_view = np.asarray(reactions_per_view, dtype=float)
+
+        # Channels are numbered in the order they come in, so posts are grouped by comparing integers, not strings
+        channel_numbers = {}
+        self.channel_numbers = np.fromiter((channel_numbers.setdefault(channel_id, len(channel_numbers))
+                                            for channel_id in (channel_ids if channel_ids is not None
+                                                               else [""] * len(links))),
+                                           dtype=np.intp, count=len(links))
+        self.channel_ids = list(channel_numbers)
+
+    @classmethod
+    def from_counts(cls, links: list, views, shares, reactions, channel_ids=None):
+
+        """
+        This method creates a table from counters of posts, one element per post, calculating their ratios.
+        """
+
+        views = np.asarray(views, dtype=float)
+
+        return cls(links,
+                   ratios(np.asarray(shares, dtype=float), views),
+                   ratios(np.asarray(reactions, dtype=float), views),
+                   channel_ids)
+
+    @classmethod
+    def from_posts_data(cls, posts_data: dict, channel_ids=None):
+
+        """
+        This method creates a table from a dict of post links mapped to raw TGStat data on them.
+        channel_ids may map the same links to channels they belong to.
+        """
+
+        links = list(posts_data)
+
+        return cls.from_counts(links,
+                               [posts_data[post_link]["viewsCount"] for post_link in links],
+                               [posts_data[post_link]["sharesCount"] for post_link in links],
+                               [posts_data[post_link]["reactionsCount"] for post_link in links],
+                               [channel_ids[post_link] for post_link in links] if channel_ids is not None else None)
+
+    @classmethod
+    def from_posts(cls, posts_dict: dict):
+
+        """
+        This method creates a table from a dict of post links mapped to Posts whose ratios are already calculated.
+        """
+
+        return cls(list(posts_dict),
+                   [post.shares_per_view for post in posts_dict.values()],
+                   [post.reactions_per_view for post in posts_dict.values()])
+
+    def metric(self, name: str):
+
+        """
+        This method returns the array of a metric by its name, e.g. "shares_per_view" or "reactions_per_view".
+        """
+
+        return getattr(self, name)
+
+    def by_channel(self, values: np.ndarray, calculate):
+
+        """
+        This method applies calculate() to the values of every channel separately and returns the results
+        in the order of posts.
+        """
+
+        result = np.zeros(len(values), dtype=float)
+
+        for channel_number in range(len(self.channel_ids)):
+            in_channel = np.flatnonzero(self.channel_numbers == channel_number)
+            result[in_channel] = calculate(values[in_channel])
+
+        return result
+
+    def percentile_ranks(self, name="shares_per_view"):
+        return self.by_channel(self.metric(name), percentile_ranks)
+
+    def z_scores(self, name="shares_per_view"):
+        return self.by_channel(self.metric(name), z_scores)
+
+    def top(self, name="shares_per_view", n=10, channel_id=None):
+
+        """
+        This method returns links of n posts with the highest value of a metric, best first.
+        If channel_id is given, only posts of that channel are ranked. Posts with equal values keep their order.
+        """
+
+        values = self.metric(name)
+        positions = np.arange(len(values))
+
+        if channel_id is not None:
+            if channel_id not in self.channel_ids:
+                return []
+            positions = positions[self.channel_numbers == self.channel_ids.index(channel_id)]
+
+        best = positions[np.argsort(-values[positions], kind="stable")[:n]]
+        return self.links[best].tolist()
@@ -0,0 +1,122 @@
+import sqlite3
+import os
+import threading
+
+
+# =========== Now we create a class that keeps every observation of post counters we've ever made ===========
+class HistoryStore:
+
+    """
+    Stats cache and sheets only hold the latest numbers of a post. This store keeps all of them:
+    every time counters of a post are fetched (from "posts/stat" or harvested from the listing),
+    views, shares and reactions are appended with the time they were fetched at. Rows are never updated.
+
+    Rows are kept in a table clustered by post and time (WITHOUT ROWID), so the history of a post
+    lies in one place on disk and a time range of it is read with a single index range scan.
+    Links are stored once, rows refer to them by a small integer id.
+    """
+
+    def __init__(self, path=None):
+
+        self.path = path or os.environ.get("TGSTAT_HISTORY_PATH", "tgstat_history.sqlite3")
+
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS posts (
+                post_id INTEGER PRIMARY KEY,
+                link TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS observations (
+                post_id INTEGER NOT NULL,
+                observed_at INTEGER NOT NULL,
+                views INTEGER NOT NULL,
+                shares INTEGER NOT NULL,
+                reactions INTEGER NOT NULL,
+                PRIMARY KEY (post_id, observed_at)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS observations_by_time ON observations (observed_at);
+            """
+        )
+        self.connection.commit()
+
+        # Links are mapped to ids once per process
+        self.post_ids = {}
+
+    def post_id(self, post_link: str):
+
+        """
+        This method returns the id of a link, adding the link to the store if needed. Should be called under the lock.
+        """
+
+        if post_link not in self.post_ids:
+            self.connection.execute("INSERT OR IGNORE INTO posts (link) VALUES (?)", (post_link,))
+            self.post_ids[post_link] = self.connection.execute("SELECT post_id FROM posts WHERE link = ?",
+                                                               (post_link,)).fetchone()[0]
+
+        return self.post_ids[post_link]
+
+    def append_many(self, posts_data: dict, observed_at: dict):
+
+        """
+        This method appends counters of several posts in one transaction.
+
+        posts_data maps post links to raw TGStat data, observed_at maps the same links to when the data
+        was fetched (unix timestamps). An observation of a post made in the same second as one already stored
+        is ignored.
+        """
+
+        with self._lock, self.connection:
+            rows = [(self.post_id(post_link), int(observed_at[post_link]),
+                     post_data["viewsCount"], post_data["sharesCount"], post_data["reactionsCount"])
+                    for post_link, post_data in posts_data.items()]
+
+            self.connection.executemany("INSERT OR IGNORE INTO observations VALUES (?, ?, ?, ?, ?)", rows)
+
+    def growth_curve(self, post_link: str, start=None, end=None):
+
+        """
+        This method returns the history of a post from start to end (unix timestamps, both optional)
+        as a list of tuples (observed_at, views, shares, reactions), oldest first.
+        """
+
+        with self._lock:
+            post_id = self.connection.execute("SELECT post_id FROM posts WHERE link = ?", (post_link,)).fetchone()
+
+            if post_id is None:
+                return []
+
+            return self.connection.execute(
+                """
+                SELECT observed_at, views, shares, reactions FROM observations
+                WHERE post_id = ? AND observed_at BETWEEN ? AND ?
+                ORDER BY observed_at
+                """,
+                (post_id[0], start if start is not None else 0, end if end is not None else 2 ** 62)).fetchall()
+
+    def observations(self, start: float, end: float):
+
+        """
+        This method returns every observation made from start to end (unix timestamps) as a dict
+        of post links mapped to lists of tuples (observed_at, views, shares, reactions), oldest first.
+        """
+
+        with self._lock:
+            rows = self.connection.execute(
+                """
+                SELECT link, observed_at, views, shares, reactions FROM observations
+                JOIN posts USING (post_id)
+                WHERE observed_at BETWEEN ? AND ?
+                ORDER BY post_id, observed_at
+                """,
+                (start, end)).fetchall()
+
+        curves = {}
+        for post_link, *observation in rows:
+            curves.setdefault(post_link, []).append(tuple(observation))
+
+        return curves
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,125 @@
+import sqlite3
+import json
+import os
+import threading
+
+
+# =========== Now we create a class that keeps the listing of channel posts on disk between runs ===========
+class ListingStore:
+
+    def __init__(self, channel_id: str, path=None):
+
+        self.channel_id = channel_id
+        self.path = path or os.environ.get("TGSTAT_CACHE_PATH", "tgstat_cache.sqlite3")
+
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS listing (
+                channel_id TEXT NOT NULL,
+                link TEXT NOT NULL,
+                date REAL NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (channel_id, link)
+            );
+            CREATE TABLE IF NOT EXISTS listing_state (
+                channel_id TEXT PRIMARY KEY,
+                last_date REAL NOT NULL,
+                last_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS listing_refresh (
+                channel_id TEXT PRIMARY KEY,
+                listed_at REAL NOT NULL
+            );
+            """
+        )
+        self.connection.commit()
+
+    def high_water_mark(self):
+
+        """
+        This method returns date (unix timestamp) and id of the newest post we have already seen,
+        or None if the listing of this channel has never been stored.
+        """
+
+        with self._lock:
+            return self.connection.execute("SELECT last_date, last_id FROM listing_state WHERE channel_id = ?",
+                                           (self.channel_id,)).fetchone()
+
+    def listed_at(self):
+
+        """
+        This method returns when the whole window of the channel was last listed and stored (unix timestamp),
+        or None if it never was or the store has been expired since.
+        """
+
+        with self._lock:
+            row = self.connection.execute("SELECT listed_at FROM listing_refresh WHERE channel_id = ?",
+                                          (self.channel_id,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def expire(self):
+
+        """
+        This method marks the stored listing of the channel as due for a full refresh (see listed_at method).
+        Stored posts are kept until the refresh replaces them.
+        """
+
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM listing_refresh WHERE channel_id = ?", (self.channel_id,))
+
+    def merge(self, posts_data: list, window_start: float):
+
+        """
+        This method adds new raw posts data to the stored listing and returns every stored post,
+        newest first, just like TGStat API does.
+
+        Posts are identified by their links, so a post that is fetched again replaces its old copy.
+        Posts dated before window_start (unix timestamp) fall out of the window and are evicted.
+        The high-water mark is moved to the newest post seen so far.
+        """
+
+        rows = [(self.channel_id, post["link"], float(post["date"]), json.dumps(post)) for post in posts_data]
+
+        with self._lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO listing VALUES (?, ?, ?, ?)", rows)
+            self.connection.execute("DELETE FROM listing WHERE channel_id = ? AND date < ?",
+                                    (self.channel_id, window_start))
+
+            if posts_data:
+                newest_post = max(posts_data, key=lambda post: (float(post["date"]), post["id"]))
+                self.connection.execute(
+                    """
+                    INSERT INTO listing_state VALUES (?, ?, ?)
+                    ON CONFLICT (channel_id) DO UPDATE SET last_date = excluded.last_date, last_id = excluded.last_id
+                    WHERE (excluded.last_date, excluded.last_id) > (last_date, last_id)
+                    """,
+                    (self.channel_id, float(newest_post["date"]), newest_post["id"])
+                )
+
+            stored_posts = self.connection.execute(
+                "SELECT data FROM listing WHERE channel_id = ? ORDER BY date DESC",
+                (self.channel_id,)
+            ).fetchall()
+
+        return [json.loads(data) for data, in stored_posts]
+
+    def replace(self, posts_data: list, window_start: float, listed_at: float):
+
+        """
+        This method drops the stored listing of the channel and stores a freshly fetched one instead.
+        listed_at (unix timestamp) is when the whole window was listed.
+        """
+
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM listing WHERE channel_id = ?", (self.channel_id,))
+            self.connection.execute("DELETE FROM listing_state WHERE channel_id = ?", (self.channel_id,))
+            self.connection.execute("INSERT OR REPLACE INTO listing_refresh VALUES (?, ?)",
+                                    (self.channel_id, listed_at))
+
+        return self.merge(posts_data, window_start)
+
+    def close(self):
+        self.connection.close()
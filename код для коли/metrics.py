@@ -0,0 +1,249 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+# =========== Metrics settings ===========
+
+# Where reports go. Every one of them is optional:
+#
+#   METRICS_REPORT      - path of a JSON report of the run
+#   METRICS_TEXTFILE    - path of a Prometheus textfile (for node_exporter's textfile collector)
+#   PROFILE             - path of a cProfile dump of the run (open it with pstats or snakeviz)
+#   TRACEMALLOC         - set to 1 to trace memory allocations, the top ones get into the JSON report
+
+# Number of allocation sites in the JSON report
+TOP_ALLOCATIONS = 10
+
+# Number of best posts of every tab in the JSON report, by each ratio
+TOP_POSTS = int(os.environ.get("TOP_POSTS", 10))
+
+
+# =========== Now we create a class that collects timings and counters of a run ===========
+class RunMetrics:
+
+    """
+    Stages are timed with stage() context manager. Time of a stage is summed over every call and every thread,
+    so for stages that run on a pool of workers (stats fetch in the streaming pipeline) it's busy time,
+    not wall time.
+
+    Requests are counted by Transport for every endpoint (see endpoint_key in rate_limiter module):
+    number of requests by status, bytes sent and received, and time spent waiting for responses.
+
+    The best posts of every tab of every channel are kept too (see record_top_posts method).
+
+    A long-running process calls reset() before every run, so reports cover a single run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        """
+        This method drops everything collected so far and starts timing a new run.
+        """
+
+        with self._lock:
+            self.started = time.time()
+
+            self.stages = {}
+            self.endpoints = {}
+
+            # Channel ids mapped to tabs mapped to ratio names mapped to links of the best posts, best first
+            self.top_posts = {}
+
+            # Filled in if the run is traced with tracemalloc (see profiled function)
+            self.memory = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+
+            with self._lock:
+                stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+                stage["calls"] += 1
+                stage["seconds"] += elapsed
+
+    def record_request(self, endpoint: str, status_code: int, bytes_sent: int, bytes_received: int,
+                       seconds: float):
+
+        with self._lock:
+            counters = self.endpoints.setdefault(endpoint, {"requests": 0,
+                                                            "statuses": {},
+                                                            "bytes_sent": 0,
+                                                            "bytes_received": 0,
+                                                            "seconds": 0.0})
+            counters["requests"] += 1
+            counters["statuses"][str(status_code)] = counters["statuses"].get(str(status_code), 0) + 1
+            counters["bytes_sent"] += bytes_sent
+            counters["bytes_received"] += bytes_received
+            counters["seconds"] += seconds
+
+    def record_top_posts(self, channel_id: str, tab: str, top_posts: dict):
+
+        """
+        This method saves links of the best posts of a tab. top_posts maps ratio names to links, best first.
+        """
+
+        with self._lock:
+            self.top_posts.setdefault(channel_id, {})[tab] = top_posts
+
+    def report(self, rate_limiter=None):
+
+        """
+        This method returns everything collected so far as a dict. If rate_limiter is given,
+        retries, time spent sleeping and quotas left are taken from it.
+        """
+
+        with self._lock:
+            report = {
+                "started": self.started,
+                "seconds": time.time() - self.started,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "endpoints": {endpoint: dict(counters, statuses=dict(counters["statuses"]))
+                              for endpoint, counters in self.endpoints.items()},
+                "top_posts": {channel_id: dict(tabs) for channel_id, tabs in self.top_posts.items()},
+            }
+
+        if rate_limiter is not None:
+            report["retries"] = rate_limiter.retries
+            report["slept_seconds"] = rate_limiter.slept
+            report["quotas_left"] = dict(rate_limiter.quotas)
+
+        if self.memory is not None:
+            report["memory"] = self.memory
+
+        return report
+
+    def write_json(self, path: str, rate_limiter=None):
+        write_atomically(path, json.dumps(self.report(rate_limiter), ensure_ascii=False, indent=2))
+
+    def write_prometheus(self, path: str, rate_limiter=None):
+        write_atomically(path, prometheus_text(self.report(rate_limiter)))
+
+
+def write_atomically(path: str, text: str):
+
+    """
+    This function writes text to a temporary file and moves it to path, so that nobody reads a half-written file.
+    """
+
+    temporary_path = f"{path}.tmp"
+
+    with open(temporary_path, "w", encoding="utf-8") as report_file:
+        report_file.write(text)
+
+    os.replace(temporary_path, path)
+
+
+def prometheus_text(report: dict):
+
+    """
+    This function turns a report into Prometheus text exposition format.
+    """
+
+    lines = []
+
+    def metric(name: str, metric_type: str, help_text: str, samples: list):
+        lines.append(f"# HELP kley_{name} {help_text}")
+        lines.append(f"# TYPE kley_{name} {metric_type}")
+        for labels, value in samples:
+            label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels.items())
+            lines.append(f"kley_{name}{{{label_text}}} {value}" if label_text else f"kley_{name} {value}")
+
+    stages = report["stages"]
+    endpoints = report["endpoints"]
+
+    metric("stage_seconds_total", "counter", "Time spent in a pipeline stage.",
+           [({"stage": name}, stage["seconds"]) for name, stage in stages.items()])
+    metric("stage_calls_total", "counter", "Number of times a pipeline stage has run.",
+           [({"stage": name}, stage["calls"]) for name, stage in stages.items()])
+
+    metric("requests_total", "counter", "Requests made to an endpoint, by response status.",
+           [({"endpoint": endpoint, "status": status}, count)
+            for endpoint, counters in endpoints.items() for status, count in counters["statuses"].items()])
+    metric("request_bytes_sent_total", "counter", "Bytes of request bodies sent to an endpoint.",
+           [({"endpoint": endpoint}, counters["bytes_sent"]) for endpoint, counters in endpoints.items()])
+    metric("request_bytes_received_total", "counter", "Bytes of response bodies received from an endpoint.",
+           [({"endpoint": endpoint}, counters["bytes_received"]) for endpoint, counters in endpoints.items()])
+    metric("request_seconds_total", "counter", "Time spent waiting for responses from an endpoint.",
+           [({"endpoint": endpoint}, counters["seconds"]) for endpoint, counters in endpoints.items()])
+
+    if "retries" in report:
+        metric("retries_total", "counter", "Requests repeated because the service was overloaded.",
+               [({}, report["retries"])])
+        metric("rate_limiter_sleep_seconds_total", "counter", "Time spent waiting for the rate limiter.",
+               [({}, report["slept_seconds"])])
+        metric("quota_left", "gauge", "Requests left in the quota of a service.",
+               [({"service": prefix}, requests_left) for prefix, requests_left in report["quotas_left"].items()])
+
+    metric("last_run_timestamp_seconds", "gauge", "When the run has started.", [({}, report["started"])])
+
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def profiled(run_metrics):
+
+    """
+    This context manager profiles the code inside it with cProfile, if PROFILE is set,
+    and traces its memory allocations with tracemalloc, if TRACEMALLOC is set to 1.
+    """
+
+    profile_path = os.environ.get("PROFILE")
+    trace_memory = os.environ.get("TRACEMALLOC") == "1"
+
+    profiler = cProfile.Profile() if profile_path else None
+
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top_allocations = tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATIONS]
+            tracemalloc.stop()
+
+            run_metrics.memory = {
+                "current_bytes": current,
+                "peak_bytes": peak,
+                "top_allocations": [{"where": str(statistic.traceback), "bytes": statistic.size,
+                                     "blocks": statistic.count} for statistic in top_allocations],
+            }
+
+
+def write_reports(transport):
+
+    """
+    This function writes reports on everything the transport's metrics have collected,
+    to the paths set in METRICS_REPORT and METRICS_TEXTFILE.
+    """
+
+    if os.environ.get("METRICS_REPORT"):
+        transport.metrics.write_json(os.environ["METRICS_REPORT"], transport.rate_limiter)
+
+    if os.environ.get("METRICS_TEXTFILE"):
+        transport.metrics.write_prometheus(os.environ["METRICS_TEXTFILE"], transport.rate_limiter)
+
+
+# The metrics shared by every transport, unless it's given its own
+default_metrics = RunMetrics()
@@ -0,0 +1,244 @@
+import queue
+import threading
+
+from engagement import EngagementTable
+from post import Post, MediaGroupCollapser, order_chronologically
+from posts_getter import cut_post_text
+from sheet_sync import sheet_row, row_changed, plan_sync, rows_after_sync
+
+
+# Marks the end of a stream in every queue
+DONE = object()
+
+
+# =========== Now we create a class that streams daily posts from TGStat pages to the "daily" sheet ===========
+class StreamingPipeline:
+
+    """
+    Instead of running every step for all posts before the next one starts, posts flow through a chain of stages,
+    each one running in its own thread(s) and connected to the next one by a bounded queue:
+
+    listing pages -> media group collapse -> text cut -> stats fetch (a pool of workers) -> sheet writer
+
+    So stats and sheet writes for the first posts overlap with fetching later pages. Bounded queues keep memory flat:
+    if a later stage falls behind, earlier ones wait for it.
+
+    The sheet writer updates rows that are already in the sheet as soon as their stats arrive.
+    Deleting outdated rows and adding new ones changes the order of rows, so that's done once all posts are in,
+    just like in a batch run (see plan_sync in sheet_sync module): outdated and duplicate rows are deleted bottom-up,
+    rows left out of chronological order by a failed sync are rewritten, then new posts are added.
+
+    If any stage fails, the rest of the stream is drained without doing any work, nothing is deleted or added,
+    and run() raises the first error.
+    """
+
+    def __init__(self, stats_calculator, data_manager, queue_size=100):
+
+        self.stats_calculator = stats_calculator
+        self.data_manager = data_manager
+        self.metrics = stats_calculator.transport.metrics
+
+        self.pages = queue.Queue(maxsize=4)
+        self.collapsed_posts = queue.Queue(maxsize=queue_size)
+        self.trimmed_posts = queue.Queue(maxsize=queue_size)
+        self.posts_with_stats = queue.Queue(maxsize=queue_size)
+
+        self.collapser = MediaGroupCollapser()
+        self.sheet_rows = []
+        self.table_rows = {}
+        self.post_stats = {}
+        self.posts_data = {}
+        self.updated = 0
+        self.skipped = 0
+
+        self.errors = []
+        self.failed = threading.Event()
+        self._lock = threading.Lock()
+        self._stats_workers_left = stats_calculator.max_workers
+
+    def fail(self, error: Exception):
+        with self._lock:
+            self.errors.append(error)
+        self.failed.set()
+
+    def run_stage(self, stage: str, input_queue: queue.Queue, handle, output_queue=None, finish=None):
+
+        """
+        This method runs a stage: it calls handle() for every item of input_queue until the end of the stream,
+        then calls finish() and passes the end of the stream on to output_queue.
+        Time spent in handle() and finish() is counted in metrics under the stage name.
+
+        After a failure items are still taken from input_queue, so that earlier stages never block on a full queue.
+        """
+
+        try:
+            while True:
+                item = input_queue.get()
+
+                if item is DONE:
+                    break
+
+                if self.failed.is_set():
+                    continue
+
+                try:
+                    with self.metrics.stage(stage):
+                        handle(item)
+                except Exception as error:
+                    self.fail(error)
+
+            if finish is not None and not self.failed.is_set():
+                try:
+                    with self.metrics.stage(stage):
+                        finish()
+                except Exception as error:
+                    self.fail(error)
+
+        finally:
+            if output_queue is not None:
+                output_queue.put(DONE)
+
+    # ----- Stage 1: listing -----
+
+    def fetch_listing(self):
+        try:
+            for page in self.stats_calculator.iter_daily_pages():
+                if self.failed.is_set():
+                    break
+                self.pages.put(page)
+        except Exception as error:
+            self.fail(error)
+        finally:
+            self.pages.put(DONE)
+
+    # ----- Stage 2: media group collapse -----
+
+    def collapse_page(self, page: list):
+        self.collapser.add_page(page)
+        for post_data in self.collapser.pop_finished():
+            self.collapsed_posts.put(Post.from_api(post_data))
+
+    def flush_groups(self):
+        for post_data in self.collapser.items():
+            self.collapsed_posts.put(Post.from_api(post_data))
+
+    # ----- Stage 3: text cut -----
+
+    def trim_text(self, post: Post):
+        post.text = cut_post_text(post.text)
+        self.trimmed_posts.put(post)
+
+    # ----- Stage 4: stats fetch -----
+
+    def fetch_stats(self, post: Post):
+        post_data = self.stats_calculator.get_cached_post_stats(post)
+        self.stats_calculator.fill_post_stats(post, post_data)
+
+        # Raw data is kept to rank posts against each other once they're all in
+        with self._lock:
+            self.posts_data[post.link] = post_data
+
+        self.posts_with_stats.put(post)
+
+    def run_stats_worker(self):
+
+        self.run_stage("stats fetch", self.trimmed_posts, self.fetch_stats)
+
+        # Every worker puts the end of the stream back for the other workers to see it,
+        # and the last one to finish passes it on to the sheet writer.
+        self.trimmed_posts.put(DONE)
+
+        with self._lock:
+            self._stats_workers_left -= 1
+            last_worker = self._stats_workers_left == 0
+
+        if last_worker:
+            self.posts_with_stats.put(DONE)
+
+    # ----- Stage 5: sheet writer -----
+
+    def write_post(self, post: Post):
+
+        self.post_stats[post.link] = post
+        table_row = self.table_rows.get(post.link)
+
+        if table_row is None:
+            return
+
+        if row_changed(table_row, sheet_row(post)):
+            self.data_manager.write_row("daily", post, row_id=table_row["id"])
+            self.updated += 1
+        else:
+            self.skipped += 1
+
+    def finish_sheet(self):
+
+        # Rows updated by the stream already hold their posts' values
+        current_rows = []
+        for table_row in self.sheet_rows:
+            post = self.post_stats.get(table_row["postUrl"])
+            if post is not None and self.table_rows[table_row["postUrl"]] is table_row:
+                current_rows.append(dict(sheet_row(post), id=table_row["id"]))
+            else:
+                current_rows.append(table_row)
+
+        post_stats = order_chronologically(self.post_stats)
+        plan = plan_sync(current_rows, post_stats)
+
+        self.data_manager.post_stats = post_stats
+        self.data_manager.apply_plan("daily", plan)
+        self.data_manager.remember_rows("daily", rows_after_sync(post_stats))
+
+        # Rows left by the stream hold their posts' values, so the plan only rewrites rows holding the wrong post
+        print(f"daily stream: {len(plan.deletes)} deleted, {self.updated} updated, {len(plan.updates)} reordered, "
+              f"{len(plan.inserts)} added, {self.skipped} unchanged rows skipped")
+
+    def write_sheet(self):
+
+        try:
+            with self.metrics.stage("daily sheet: read"):
+                table_rows = self.data_manager.read_rows("daily")
+            self.sheet_rows = table_rows
+            # A link in more than one row (left by a sync that has failed halfway) is updated in the first row only
+            for table_row in table_rows:
+                self.table_rows.setdefault(table_row["postUrl"], table_row)
+            self.data_manager.forget_rows("daily")
+        except Exception as error:
+            self.fail(error)
+
+        self.run_stage("daily sheet: update", self.posts_with_stats, self.write_post, finish=self.finish_sheet)
+
+    def run(self):
+
+        """
+        This method runs every stage, waits for the stream to end and returns a dict of daily posts with their stats,
+        in chronological order. If any stage has failed, it raises the first error.
+        """
+
+        threads = [
+            threading.Thread(target=self.fetch_listing),
+            threading.Thread(target=self.run_stage,
+                             args=("group collapse", self.pages, self.collapse_page, self.collapsed_posts,
+                                   self.flush_groups)),
+            threading.Thread(target=self.run_stage,
+                             args=("text cut", self.collapsed_posts, self.trim_text, self.trimmed_posts)),
+            *[threading.Thread(target=self.run_stats_worker) for _ in range(self.stats_calculator.max_workers)],
+            threading.Thread(target=self.write_sheet),
+        ]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        with self.metrics.stage("ordering"):
+            self.post_stats = order_chronologically(self.post_stats)
+        with self.metrics.stage("rankings"):
+            table = EngagementTable.from_posts_data({post_link: self.posts_data[post_link]
+                                                     for post_link in self.post_stats})
+            self.stats_calculator.fill_rankings(self.post_stats, table)
+        self.stats_calculator.daily_posts = self.post_stats
+        return self.post_stats
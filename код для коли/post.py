@@ -0,0 +1,162 @@
+import datetime as dt
+
+
+# Counters we need for a post, mapped to the names they may have in an item of TGStat "channels/posts" response
+LISTING_COUNTERS = {
+    "viewsCount": ("viewsCount", "views"),
+    "sharesCount": ("sharesCount", "shares"),
+    "reactionsCount": ("reactionsCount", "reactions"),
+}
+
+
+def harvest_stats(post_data: dict):
+
+    """
+    This function takes counters of a post right from an item of TGStat listing and returns them
+    the way "posts/stat" does, e.g. {"viewsCount": 100, "sharesCount": 3, "reactionsCount": 5}.
+    If any counter is missing from the item, it returns None.
+    """
+
+    stats = {}
+
+    for field, names in LISTING_COUNTERS.items():
+        values = [post_data[name] for name in names if isinstance(post_data.get(name), (int, float))]
+        if not values:
+            return
+
+        stats[field] = values[0]
+
+    return stats
+
+
+# =========== A single post, from TGStat listing to a row in the sheet ===========
+class Post:
+
+    # There may be thousands of posts in a backfill, so instead of a dict per post we keep a fixed set of slots
+    __slots__ = ("link", "date", "text", "group_id", "listed_stats", "shares_per_view", "reactions_per_view",
+                 "shares_per_view_percentile", "shares_per_view_z_score",
+                 "reactions_per_view_percentile", "reactions_per_view_z_score")
+
+    def __init__(self, link: str, date: dt.datetime, text: str, group_id=None, listed_stats=None):
+        self.link = link
+        self.date = date
+        self.text = text
+        self.group_id = group_id
+
+        # Counters the listing came with: a tuple of when the post was listed (unix timestamp) and its stats
+        # (see harvest_stats function), or None if the listing didn't have all of them
+        self.listed_stats = listed_stats
+
+        # Filled in by StatCalculator.calculate_posts_stats
+        self.shares_per_view = None
+        self.reactions_per_view = None
+
+        # Where the post stands among posts of the same set (see StatCalculator.fill_rankings)
+        self.shares_per_view_percentile = None
+        self.shares_per_view_z_score = None
+        self.reactions_per_view_percentile = None
+        self.reactions_per_view_z_score = None
+
+    @classmethod
+    def from_api(cls, post: dict):
+
+        """
+        This method creates a Post from an item of TGStat "channels/posts" response.
+        """
+
+        stats = harvest_stats(post)
+
+        return cls(link=post["link"],
+                   date=dt.datetime.fromtimestamp(float(post["date"])),
+                   text=post["text"],
+                   group_id=post["group_id"],
+                   listed_stats=(post["listed_at"], stats) if stats is not None and "listed_at" in post else None)
+
+    def __repr__(self):
+        return f"Post({self.link!r}, {self.date:%d.%m.%y %H:%M})"
+
+
+def message_id(post_data: dict):
+
+    """
+    This function returns the number of a post in its channel from an item of TGStat "channels/posts" response.
+    """
+
+    return int(post_data["link"].rsplit("/", 1)[-1])
+
+
+# =========== Media groups are collapsed while pages of the listing arrive ===========
+class MediaGroupCollapser:
+
+    """
+    Every mediafile in Telegram channel has its own link. We can tell, if some links are actually just
+    different photos//videos in a single post, by looking at "group_id" attribute.
+    But only the first link (i.e. the link with the smallest number after /) has reactions, shares etc.
+
+    This class takes items of TGStat listing one by one and keeps every post without a group,
+    plus a single item per group: the one with the smallest message id seen so far.
+    So memory and work grow with the number of posts, not with the number of mediafiles in them.
+    """
+
+    def __init__(self):
+        # Keys are links for posts without a group and group ids for media groups. Dicts keep insertion order,
+        # so posts come out in the order they came in.
+        self.posts = {}
+
+        # Date of the oldest item seen so far and groups that have already been popped (see pop_finished method)
+        self.oldest_date = None
+        self.finished_groups = set()
+
+    def add(self, post_data: dict):
+
+        post_date = float(post_data["date"])
+        if self.oldest_date is None or post_date < self.oldest_date:
+            self.oldest_date = post_date
+
+        if post_data["group_id"] is None:
+            self.posts[post_data["link"]] = post_data
+            return
+
+        key = ("group", post_data["group_id"])
+        if key in self.finished_groups:
+            return
+
+        first_post = self.posts.get(key)
+
+        if first_post is None or message_id(post_data) < message_id(first_post):
+            self.posts[key] = post_data
+
+    def add_page(self, posts_data: list):
+        for post_data in posts_data:
+            self.add(post_data)
+
+    def items(self):
+        return list(self.posts.values())
+
+    def pop_finished(self):
+
+        """
+        This method removes and returns items that can't change any more, in the order they came in.
+
+        TGStat lists posts newest first, and every item of a media group has the same date. So once an older item
+        has arrived, groups with newer dates are complete. Posts without a group are complete right away.
+        """
+
+        finished_keys = [key for key, post_data in self.posts.items()
+                         if not isinstance(key, tuple) or float(post_data["date"]) > self.oldest_date]
+
+        for key in finished_keys:
+            if isinstance(key, tuple):
+                self.finished_groups.add(key)
+
+        return [self.posts.pop(key) for key in finished_keys]
+
+
+def order_chronologically(posts_dict: dict):
+
+    """
+    This function returns a new dict of posts (links mapped to Post objects) ordered by post date.
+    Posts with the same date keep the order they came in.
+    """
+
+    return dict(sorted(posts_dict.items(), key=lambda item: item[1].date))
@@ -1,351 +1,500 @@
-import requests
 import datetime as dt
 # from dotenv import load_dotenv
+import math
 import os
+import re
+import threading
 import time
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from stats_cache import StatsCache
+from history_store import HistoryStore
+from listing_store import ListingStore
+from transport import default_transport
+from post import Post, MediaGroupCollapser, order_chronologically
+from engagement import EngagementTable, ratios
+from request_planner import plan_requests
+import dates
 
 # load_dotenv()
 
-# =========== Get today's date ===========
-today = dt.datetime.today()  # dt.datetime(year=2024, month=10, day=16, hour=10)
-today_unix = time.mktime(today.timetuple())
-
-# =========== Calculate which date it was a month ago ===========
-a_month_ago = today - dt.timedelta(days=31)
-a_month_ago_unix = time.mktime(a_month_ago.timetuple())
-
-
-# =========== We'll need dates of start and end of previous month ===========
-
-# Here we're getting the start of prev month. If it's January, we can't just subtract, so we set the date manually
-if today.month == 1:
-    prev_year = (today - dt.timedelta(days=35)).year
-    start_of_prev_month = dt.datetime(year=prev_year,
-                                      month=12,
-                                      day=1)
-
-
-# If it's not January, we can just subtract one from month number
-else:
-    start_of_prev_month = dt.datetime(year=today.year,
-                                      month=today.month - 1,
-                                      day=1)
-
-start_of_prev_month_unix = time.mktime(start_of_prev_month.timetuple())
-
-
-# Here we're getting the last day of prev month. We don't know what it is or if it's a leap year,
-# so we need to check four possible last dates: 31st, 30th, 29th and 28th.
-
-try:
-    end_of_prev_month = dt.datetime(year=start_of_prev_month.year,
-                                    month=start_of_prev_month.month,
-                                    day=31,
-                                    hour=23,
-                                    minute=59,
-                                    second=59)
-except ValueError:
-    try:
-        end_of_prev_month = dt.datetime(year=start_of_prev_month.year,
-                                        month=start_of_prev_month.month,
-                                        day=30,
-                                        hour=23,
-                                        minute=59,
-                                        second=59)
-    except ValueError:
-        try:
-            end_of_prev_month = dt.datetime(year=start_of_prev_month.year,
-                                            month=start_of_prev_month.month,
-                                            day=29,
-                                            hour=23,
-                                            minute=59,
-                                            second=59)
-        except ValueError:
-            end_of_prev_month = dt.datetime(year=start_of_prev_month.year,
-                                            month=start_of_prev_month.month,
-                                            day=28,
-                                            hour=23,
-                                            minute=59,
-                                            second=59)
-
-end_of_prev_month_unix = time.mktime(end_of_prev_month.timetuple())
+
+class ListingError(Exception):
+    """
+    Raised when TGStat API doesn't return a page of channel posts.
+    """
+
+
+# Maximum number of posts returned in a single "channels/posts" call
+PAGE_LIMIT = 50
+
+# In incremental mode the whole daily window is listed again every LISTING_REFRESH_HOURS hours,
+# so posts deleted from the channel leave the stored listing and edited texts are picked up
+LISTING_REFRESH_HOURS = float(os.environ.get("LISTING_REFRESH_HOURS", 24))
+
+# Posts aren't spread evenly over time, so time slices are sized for this share of a page.
+# A slice that still gets more posts than a page needs a second call.
+SLICE_FILL = 0.8
+
+
+def time_slices(start_time: float, end_time: float, count: int):
+
+    """
+    This function splits the window from start_time to end_time (unix timestamps) into count slices
+    of equal length and returns them as a list of (start, end) tuples, newest first, just like TGStat lists posts.
+
+    Both ends of a call are inclusive, so neighbouring slices share a second: posts published in it
+    are listed twice and deduplicated by link later.
+    """
+
+    count = max(1, min(count, int(end_time - start_time)))
+    length = (end_time - start_time) / count
+    edges = [start_time] + [int(start_time + length * i) for i in range(1, count)] + [end_time]
+
+    return [(edges[i], edges[i + 1]) for i in reversed(range(count))]
+
+
+# Words of a post are runs of non-whitespace characters, the same ones str.split() would give
+WORD_PATTERN = re.compile(r"\S+")
+PREVIEW_WORDS = 10
+
+
+def preview_word(word: str):
+
+    """
+    This function strips HTML tags from a single word of a post text.
+
+    If the word ends with a tag, we take what comes before the first ">" (e.g. "word</b>" -> "word"),
+    else we take what comes after the last ">" (e.g. "<b>word" -> "word"). Anything from "<" on is dropped.
+    """
+
+    if word.endswith(">"):
+        word = word[:word.find(">")]
+    else:
+        word = word[word.rfind(">") + 1:]
+
+    tag_start = word.find("<")
+    if tag_start != -1:
+        word = word[:tag_start]
+
+    return word
+
+
+def cut_post_text(text: str):
+
+    """
+    This function turns the text of a post into a preview: first ten words from the original text,
+    followed by ellipsis (...). If the post has no text, the preview is: "*пост без текста*".
+
+    Words are found lazily, so the scan stops after the tenth word no matter how long the post is.
+    """
+
+    words = islice(WORD_PATTERN.finditer(text), PREVIEW_WORDS)
+    text_redacted = " ".join(preview_word(match.group()) for match in words)
+    if text_redacted == "":
+        text_redacted = "*пост без текста*"
+    else:
+        text_redacted += "..."
+
+    return text_redacted
 
 
 # =========== Now we create a class that allows us to get data on different posts, sort it and calculate stats =========
 class StatCalculator:
 
-    def __init__(self):
+    def __init__(self, channel_id="t.me/kleymedia", max_workers=4, transport=None, stats_cache=None,
+                 incremental=False, stats_budget=None, harvest_listing=False, history_store=None):
         self.tgstat_token = os.environ["TG_STATS_TOKEN"]
+        self.channel_id = channel_id
         self.posts_from_channel_endpoint = "https://api.tgstat.ru/channels/posts"
         self.posts_stats_endpoint = "https://api.tgstat.ru/posts/stat"
         self.daily_posts = {}
         self.monthly_posts = {}
 
-    def get_daily_posts_data(self):
+        # Post stats are fetched by a pool of workers. "max_workers" is the max number of requests in flight.
+        # Every request goes through the transport, which keeps connections alive and paces requests
+        # with the rate limiter shared by all workers (see transport and rate_limiter modules).
+        self.max_workers = max_workers
+        self.transport = transport if transport is not None else default_transport
+
+        # TGStat data on posts is kept on disk between runs, so posts whose stats are still fresh are not re-requested
+        self.stats_cache = stats_cache if stats_cache is not None else StatsCache()
+
+        # Every fetched set of counters is also appended to the history of its post, nothing is ever overwritten there
+        self.history_store = history_store if history_store is not None else HistoryStore()
+
+        # In incremental mode the listing of daily posts is kept on disk too, and only posts newer
+        # than the newest one we have already seen are requested (see sync_daily_listing method)
+        self.listing_store = ListingStore(self.channel_id) if incremental else None
 
+        # Max number of post stats requests per run (None for no limit). Once it's spent, posts whose stats
+        # have expired carry their previous values forward (see request_planner module).
+        self.stats_budget = stats_budget
+        self.requests_left = stats_budget
+        self._budget_lock = threading.Lock()
+
+        # If the listing comes with every counter we need, stats are taken from it instead of "posts/stat"
+        # (see harvest_stats in post module). Counters missing from the listing are still requested per post.
+        self.harvest_listing = harvest_listing
+
+    def clear_posts(self):
+
+        """
+        This method drops posts collected by the previous run, so a long-running process starts every run afresh.
         """
-        This method retrieves data on posts dated from today to one month prior from TGStat API.
-        Some posts go directly to posts dict (self.daily_posts), some are returned in a separate dict.
 
-        Note that every mediafile in Telegram channel has its own link. We can tell, if some links are actually just
-        different photos//videos in a single post, by looking at "group_id" attribute.
+        self.daily_posts = {}
+        self.monthly_posts = {}
+        self.requests_left = self.stats_budget
 
-        If it's None, the method adds that post link, date and text to posts dictionary (self.daily_posts).
-        Else (if it's anything but None), the method stores it in a dictionary,
-        where all posts are grouped by their "group_id" attribute. At the end, the method returns that dictionary.
+    def take_requests(self, count: int):
+
+        """
+        This method takes up to count requests from the budget of this run and returns how many it has got.
         """
 
-        # Maximum number of posts returned in a single API call is 50. So, to get data on all post for one month,
-        # we need to repeatedly call the API.
+        with self._budget_lock:
+            if self.requests_left is None:
+                return count
 
-        offset = 0
-        limit = 50
-        count = 50
-        links_and_dates = {}
-
-        while count == limit:
-            # If we get 50 posts in response to API call, it probably means, that we didn't get all the posts.
-            # So we increase offset by limit (by 50) and repeat the call until we get a count which is less than limit.
-            # If the number of posts is divisible by 50 with no remainder, the function will catch it and escape.
-
-            get_posts_from_channel_params = {
-                "token": self.tgstat_token,
-                "channelId": "t.me/kleymedia",
-                "startTime": a_month_ago_unix,
-                "endTime": today_unix,
-                "limit": limit,
-                "offset": offset,
-                "hideForwards": 1,
-                "hideDeleted": 1,
-                # "extended": 1,
-            }
-
-            posts_response = requests.get(url=self.posts_from_channel_endpoint, params=get_posts_from_channel_params)
+            granted = min(count, self.requests_left)
+            self.requests_left -= granted
+            return granted
+
+    def get_posts_page(self, start_time: float, end_time: float, offset: int):
+
+        """
+        This method requests a single page of posts dated from start_time to end_time (unix timestamps)
+        from TGStat API and returns the "response" part of it. If the API call fails, the method raises ListingError.
+        """
+
+        get_posts_from_channel_params = {
+            "token": self.tgstat_token,
+            "channelId": self.channel_id,
+            "startTime": start_time,
+            "endTime": end_time,
+            "limit": PAGE_LIMIT,
+            "offset": offset,
+            "hideForwards": 1,
+            "hideDeleted": 1,
+            # "extended": 1,
+        }
+
+        with self.transport.metrics.stage("listing fetch"):
+            posts_response = self.transport.get(self.posts_from_channel_endpoint,
+                                                params=get_posts_from_channel_params)
 
             if posts_response.status_code != 200:
-                print(f"API call error. Response code: {posts_response.status_code}")
-                return
-            print(posts_response.text)
-            print(posts_response.json())
-            print('============================')
+                raise ListingError(f"API call error. Response code: {posts_response.status_code}")
+            response_data = posts_response.json()["response"]
 
-            if posts_response.json()["response"]["count"] == 0:
-                return
+        # Counters in the listing are as fresh as the listing itself, so every item remembers when it was listed
+        listed_at = time.time()
+        for post_data in response_data["items"]:
+            post_data["listed_at"] = listed_at
 
-            posts_data = posts_response.json()["response"]["items"]
-
-            for post in posts_data:
-                if post["group_id"] is None:
-                    self.daily_posts[post["link"]] = {
-                        "date": dt.datetime.fromtimestamp(float(post["date"])),
-                        "text": post["text"],
-                    }
-
-                elif post["group_id"] not in links_and_dates:
-                    links_and_dates[post["group_id"]] = [
-                        {
-                            "date": dt.datetime.fromtimestamp(float(post["date"])),
-                            "link": post["link"],
-                            "text": post["text"],
-                        }
-                    ]
-
-                else:
-                    links_and_dates[post["group_id"]].append(
-                        {
-                            "date": dt.datetime.fromtimestamp(float(post["date"])),
-                            "link": post["link"],
-                            "text": post["text"],
-                        }
-                    )
-
-            offset += count
-            count = posts_response.json()["response"]["count"]
-            time.sleep(1)
-
-        return links_and_dates
+        return response_data
 
-    def get_monthly_posts_data(self):
+    @staticmethod
+    def is_last_page(response_data: dict, offset: int):
 
         """
-        This method retrieves data on posts dated from the start to the end of last month from TGStat API.
-        Some posts go directly to monthly posts dict (self.monthly_posts), some are returned in a separate dict.
+        This method checks if a page is the last one of its window. offset is the number of posts
+        listed so far, this page included.
 
-        Note that every mediafile in Telegram channel has its own link. We can tell, if some links are actually just
-        different photos//videos in a single post, by looking at "group_id" attribute.
+        A page shorter than the limit is always the last one. A full page may be the last one too,
+        if the number of posts is divisible by the limit: TGStat tells how many posts the window has,
+        so we stop once we've got them all instead of asking for an empty page.
+        """
+
+        if len(response_data["items"]) < PAGE_LIMIT:
+            return True
+
+        return response_data.get("total_count") is not None and offset >= response_data["total_count"]
+
+    def iter_posts_pages(self, start_time: float, end_time: float):
 
-        If it's None, the method adds that post link, date and text to posts dictionary (self.monthly_posts).
-        Else (if it's anything but None), the method stores it in a dictionary,
-        where all posts are grouped by their "group_id" attribute. At the end, the method returns that dictionary.
+        """
+        This method requests posts dated from start_time to end_time (unix timestamps) from TGStat API
+        page by page and yields a list of raw posts data for every page as soon as it arrives.
+
+        If an API call fails, the method raises ListingError.
         """
 
         # Maximum number of posts returned in a single API call is 50. So, to get data on all post for one month,
-        # we need to repeatedly call the API.
+        # we need to repeatedly call the API, increasing offset by the number of posts we've got.
 
         offset = 0
-        limit = 50
-        count = 50
-        links_and_dates = {}
-
-        if not dt.datetime(year=today.year,
-                           month=today.month,
-                           day=14) <= today <= dt.datetime(year=today.year,
-                                                           month=today.month,
-                                                           day=16,
-                                                           hour=23,
-                                                           minute=59,
-                                                           second=59):
-            print("wrong date")
-            return links_and_dates
 
-        else:
+        while True:
+            response_data = self.get_posts_page(start_time, end_time, offset)
+
+            if not response_data["items"]:
+                break
+
+            yield response_data["items"]
+
+            offset += len(response_data["items"])
+            if self.is_last_page(response_data, offset):
+                break
+
+    def iter_sliced_pages(self, start_time: float, end_time: float):
 
-            while count == limit:
-                # If we get 50 posts in response to API call, it probably means, that we didn't get all the posts.
-                # So we repeat the call until we get a count which is less than limit.
-                # If the number of posts is divisible by 50 with no remainder, the function will catch it and escape.
-
-                get_posts_from_channel_params = {
-                    "token": self.tgstat_token,
-                    "channelId": "t.me/kleymedia",
-                    "startTime": start_of_prev_month_unix,
-                    "endTime": end_of_prev_month_unix,
-                    "limit": limit,
-                    "offset": offset,
-                    "hideForwards": 1,
-                    "hideDeleted": 1,
-                    # "extended": 1,
-                }
-
-                posts_response = requests.get(url=self.posts_from_channel_endpoint,
-                                              params=get_posts_from_channel_params)
-
-                if posts_response.status_code != 200:
-                    print(f"API call error. Response code: {posts_response.status_code}")
-                    return
-
-                if posts_response.json()["response"]["count"] == 0:
-                    return
-
-                posts_data = posts_response.json()["response"]["items"]
-
-                for post in posts_data:
-                    if post["group_id"] is None:
-                        self.monthly_posts[post["link"]] = {
-                            "date": dt.datetime.fromtimestamp(float(post["date"])),
-                            "text": post["text"],
-                        }
-
-                    elif post["group_id"] not in links_and_dates:
-                        links_and_dates[post["group_id"]] = [
-                            {
-                                "date": dt.datetime.fromtimestamp(float(post["date"])),
-                                "link": post["link"],
-                                "text": post["text"],
-                            }
-                        ]
-
-                    else:
-                        links_and_dates[post["group_id"]].append(
-                            {
-                                "date": dt.datetime.fromtimestamp(float(post["date"])),
-                                "link": post["link"],
-                                "text": post["text"],
-                            }
-                        )
-
-                offset += count
-                count = posts_response.json()["response"]["count"]
-                time.sleep(1)
-
-            return links_and_dates
-
-    def find_first_link(self, posts_dict: dict, mode: str):
-
-        """
-        This method receives a dictionary of posts grouped by their "group_id" attribute,
-        finds the link with the smallest number in its link
-        and adds this posts link, date and text to the posts dictionary.
-
-        If the mode parameter is set to "daily", the method saves these link,
-        date and text to daily dictionary (self.daily_posts).
-        If it's set to "monthly", data is saved to monthly dictionary (self.monthly_posts).
-
-        We do this since same "group_id" indicates, that different links refer to different mediafiles in a single post.
-        But only the first link (i.e. the link with the smallest number after /) has reactions, shares etc.
         """
+        This method yields pages of posts dated from start_time to end_time (unix timestamps), newest first,
+        just like iter_posts_pages, but without waiting for every page before requesting the next one.
 
-        if posts_dict == {}:
+        The first page tells how many posts the window has. The rest of the window (from start_time to the oldest
+        post on the first page) is split into time slices, most of a page of posts each, and all of them are requested
+        at the same time by a pool of "max_workers" workers, paced by the rate limiter. So the listing takes as long
+        as the slowest slice, not as long as every page one after another, and costs about as many calls.
+        A slice that turns out to have more posts than a page is paged through on its own.
+
+        Pages are yielded in order, every post only once: posts listed twice (on the edges of slices) are dropped.
+        If an API call fails, the method raises ListingError.
+        """
+
+        first_page = self.get_posts_page(start_time, end_time, 0)
+        seen_links = set()
+
+        def new_posts(page: list):
+            posts_data = [post_data for post_data in page if post_data["link"] not in seen_links]
+            seen_links.update(post_data["link"] for post_data in posts_data)
+            return posts_data
+
+        if first_page["items"]:
+            yield new_posts(first_page["items"])
+
+        if not first_page["items"] or self.is_last_page(first_page, len(first_page["items"])):
             return
 
+        rest_end = min(float(post_data["date"]) for post_data in first_page["items"])
+
+        # Without the total, the rest of the window is split by day
+        if first_page.get("total_count") is not None:
+            slice_count = math.ceil((first_page["total_count"] - len(first_page["items"])) / (PAGE_LIMIT * SLICE_FILL))
         else:
+            slice_count = math.ceil((rest_end - start_time) / dt.timedelta(days=1).total_seconds())
 
-            for gr_id, pst_specs in posts_dict.items():
+        slices = time_slices(start_time, rest_end, slice_count)
 
-                links = [post["link"] for post in pst_specs]
-                link_ints = [int(link.split("/")[-1]) for link in links]
-                min_link = min(link_ints)
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(slices)))
+        try:
+            futures = [executor.submit(lambda time_slice: list(self.iter_posts_pages(*time_slice)), time_slice)
+                       for time_slice in slices]
 
-                first_link = links[link_ints.index(min_link)]
-                first_link_date = [post["date"] for post in pst_specs if post["link"] == first_link][0]
-                first_link_text = [post["text"] for post in pst_specs if post["link"] == first_link][0]
+            for future in futures:
+                for page in future.result():
+                    posts_data = new_posts(page)
+                    if posts_data:
+                        yield posts_data
 
-                if mode == "daily":
-                    self.daily_posts[first_link] = {
-                        "date": first_link_date,
-                        "text": first_link_text
-                    }
+        finally:
+            # If a slice has failed, or whoever reads the pages has stopped, slices that haven't started are dropped
+            executor.shutdown(wait=True, cancel_futures=True)
 
-                elif mode == "monthly":
-                    self.monthly_posts[first_link] = {
-                        "date": first_link_date,
-                        "text": first_link_text
-                    }
+    def get_posts_data(self, start_time: float, end_time: float):
 
-    def cut_text(self, posts_dict: dict):
+        """
+        This method retrieves raw data on every post dated from start_time to end_time (unix timestamps)
+        from TGStat API and returns it as a list. If an API call fails, the method returns None.
 
+        Pages are requested concurrently, in time slices (see iter_sliced_pages method).
+        Media groups are collapsed as pages arrive: only the first item of every group is kept
+        (see MediaGroupCollapser in post module).
         """
-        This method receives a dictionary of posts and redacts the "text" attribute of each item in dictionary.
 
-        The resulting text is first ten words from the original text, followed by ellipsis (...).
+        posts_data = MediaGroupCollapser()
+
+        try:
+            for page in self.iter_sliced_pages(start_time, end_time):
+                with self.transport.metrics.stage("group collapse"):
+                    posts_data.add_page(page)
+        except ListingError as error:
+            print(error)
+            return
+
+        return posts_data.items()
+
+    def iter_daily_pages(self):
 
-        If the post has no text, the resulting text will be: "*пост без текста*".
         """
+        This method yields raw data on daily posts page by page, as soon as every page arrives.
 
-        if posts_dict == {}:
+        In incremental mode the stored listing is synced first and the whole window is yielded at once.
+        If an API call fails, the method raises ListingError.
+        """
+
+        if self.listing_store is None:
+            yield from self.iter_sliced_pages(dates.a_month_ago_unix, dates.today_unix)
             return
 
+        posts_data = self.sync_daily_listing()
+
+        if posts_data is None:
+            raise ListingError("Couldn't sync the stored listing")
+
+        yield posts_data
+
+    @staticmethod
+    def add_posts(posts_data: list, posts_dict: dict):
+
+        """
+        This method receives a list of raw posts data with media groups already collapsed,
+        adds every post to posts dictionary (posts_dict) as a Post and returns that dictionary.
+        """
+
+        for post_data in posts_data:
+            post = Post.from_api(post_data)
+            posts_dict[post.link] = post
+
+        return posts_dict
+
+    def get_daily_posts_data(self):
+
+        """
+        This method retrieves data on posts dated from today to one month prior from TGStat API,
+        adds them to daily posts dict (self.daily_posts) and returns it. If an API call fails, it returns None.
+
+        In incremental mode only new posts are requested, the rest are taken from the stored listing.
+        """
+
+        if self.listing_store is None:
+            posts_data = self.get_posts_data(dates.a_month_ago_unix, dates.today_unix)
         else:
+            posts_data = self.sync_daily_listing()
+
+        if posts_data is None:
+            return
+
+        return self.add_posts(posts_data, self.daily_posts)
+
+    def get_monthly_posts_data(self):
+
+        """
+        This method retrieves data on posts dated from the start to the end of last month from TGStat API,
+        adds them to monthly posts dict (self.monthly_posts) and returns it. If an API call fails, it returns None.
+
+        Monthly results are only collected on 14th, 15th and 16th, on other days the method returns an empty dict.
+        """
+
+        if not dates.is_results_period():
+            print("wrong date")
+            return {}
 
-            for post_link, post_data in posts_dict.items():
+        posts_data = self.get_posts_data(dates.start_of_prev_month_unix, dates.end_of_prev_month_unix)
 
-                string_list = []
+        if posts_data is None:
+            return
 
-                for word in post_data["text"].split():
+        return self.add_posts(posts_data, self.monthly_posts)
 
-                    temp1 = word.split(">")
-                    # temp2 = ""
+    def get_daily_and_monthly_posts_data(self):
 
-                    if temp1[-1] == "":
-                        temp2 = temp1[0]
-                    else:
-                        temp2 = temp1[-1]
+        """
+        This method retrieves data on both daily and monthly posts and returns two dicts of posts:
+        first for daily posts (self.daily_posts), second for monthly ones (self.monthly_posts).
+
+        On 14th, 15th and 16th the daily window (from a month ago to today) and the monthly window
+        (previous calendar month) overlap heavily. So instead of calling the API for each of them, the method
+        gets all posts from the start of the earliest window to today in one go and splits them locally.
+        On any other day only the daily window is needed, so the method just gets daily posts.
+        """
 
-                    temp3 = temp2.split("<")[0]
-                    string_list.append(temp3)
+        if not dates.is_results_period():
+            return self.get_daily_posts_data(), self.get_monthly_posts_data()
 
-                text_redacted = " ".join(string_list[:10])
-                if text_redacted == "":
-                    text_redacted = "*пост без текста*"
-                else:
-                    text_redacted += "..."
+        window_start = min(dates.a_month_ago_unix, dates.start_of_prev_month_unix)
+        posts_data = self.get_posts_data(window_start, dates.today_unix)
 
-                post_data["text"] = text_redacted
+        if posts_data is None:
+            return None, None
+
+        daily_posts_data = [post for post in posts_data
+                            if dates.a_month_ago_unix <= float(post["date"]) <= dates.today_unix]
+
+        if self.listing_store is not None:
+            # We've just got the whole daily window anyway, so the stored listing is refreshed from scratch
+            self.listing_store.replace(daily_posts_data, dates.a_month_ago_unix, listed_at=dates.today_unix)
+
+        monthly_posts_data = [post for post in posts_data
+                              if dates.start_of_prev_month_unix <= float(post["date"]) <= dates.end_of_prev_month_unix]
+
+        return (self.add_posts(daily_posts_data, self.daily_posts),
+                self.add_posts(monthly_posts_data, self.monthly_posts))
+
+    def sync_daily_listing(self):
+
+        """
+        This method brings the stored listing of daily posts up to date and returns every post in it.
+
+        The store remembers date and id of the newest post we have already seen (the high-water mark).
+        Only posts dated from that point to today are requested from TGStat API, which on an hourly run
+        is usually a single page. They're merged into the stored listing, and posts older than a month are evicted.
+
+        Posts already stored are never checked against TGStat again by such a sync, so a post deleted from
+        the channel would stay in the listing, and an edited one would keep its old text. That's why the whole
+        daily window is requested and the stored listing is replaced with it every LISTING_REFRESH_HOURS hours,
+        or if the store has been expired (see ListingStore.expire), or if there's no high-water mark yet.
+
+        If an API call fails, the method returns None and the stored listing is left as is.
+        """
+
+        high_water_mark = self.listing_store.high_water_mark()
+        listed_at = self.listing_store.listed_at()
+
+        full_listing = (high_water_mark is None or listed_at is None
+                        or dates.today_unix - listed_at >= LISTING_REFRESH_HOURS * 3600)
+
+        if full_listing:
+            start_time = dates.a_month_ago_unix
+        else:
+            # Posts published in the same second as the newest one we've seen are requested again,
+            # the store tells them apart by their links.
+            start_time = max(high_water_mark[0], dates.a_month_ago_unix)
+
+        new_posts_data = self.get_posts_data(start_time, dates.today_unix)
+
+        if new_posts_data is None:
+            return
+
+        # Listings stored before groups were collapsed during pagination may still hold every item of a group
+        stored_posts = MediaGroupCollapser()
+        with self.transport.metrics.stage("group collapse"):
+            if full_listing:
+                stored_posts.add_page(self.listing_store.replace(new_posts_data, dates.a_month_ago_unix,
+                                                                 listed_at=dates.today_unix))
+            else:
+                stored_posts.add_page(self.listing_store.merge(new_posts_data, dates.a_month_ago_unix))
+
+        return stored_posts.items()
+
+    def cut_text(self, posts_dict: dict):
+
+        """
+        This method receives a dictionary of posts and redacts the "text" attribute of each item in dictionary.
+
+        The resulting text is first ten words from the original text, followed by ellipsis (...).
+
+        If the post has no text, the resulting text will be: "*пост без текста*".
+        """
+
+        if posts_dict == {}:
+            return
+
+        else:
+
+            for post_link, post in posts_dict.items():
+                post.text = cut_post_text(post.text)
 
     def order_post_chronologically(self, mode: str):
 
         """
         This method reorders the posts dictionary so that posts are stored in chronological order.
+        Posts are sorted by date, posts with the same date keep their order.
 
         If the "mode" parameter is set to "daily", the method reorders daily dictionary.
         If "mode" is set to "monthly", the monthly dictionary is reordered.
@@ -358,78 +507,239 @@ class StatCalculator:
                 return
             copied_dict = self.monthly_posts.copy()
 
-        flipped_dict = {}
-        ordered_dict = {}
-
-        for link, data in copied_dict.items():
-            if data["date"] not in flipped_dict:
-                flipped_dict[data["date"]] = [
-                    {"link": link,
-                     "text": data["text"],
-                     }
-                ]
-            else:
-                flipped_dict[data["date"]].append(
-                    {
-                        "link": link,
-                        "text": data["text"]
-                    }
-                )
-
-        while len(flipped_dict) != 0:
-            min_dt = today
-            for date, data in flipped_dict.items():
-                if date < min_dt:
-                    min_dt = date
-            for post in flipped_dict[min_dt]:
-                ordered_dict[post["link"]] = {
-                    "date": min_dt,
-                    "text": post["text"]
-                }
-
-            flipped_dict.pop(min_dt)
+        ordered_dict = order_chronologically(copied_dict)
 
         if mode == "daily":
             self.daily_posts = ordered_dict
         elif mode == "monthly":
             self.monthly_posts = ordered_dict
 
+    def get_post_stats(self, post_link: str):
+
+        """
+        This method calls the TGStat API for a single post and returns raw post data (views, shares, reactions etc.).
+        """
+
+        get_posts_stats_params = {
+            "token": self.tgstat_token,
+            "postId": post_link,
+        }
+
+        post_response = self.transport.get(self.posts_stats_endpoint, params=get_posts_stats_params)
+        return post_response.json()["response"]
+
+    def usable_listed_stats(self, post: Post, entry):
+
+        """
+        This method returns counters a post came with in the listing as a tuple of when it was listed and its stats,
+        if they're newer than the cache entry of the post (see StatsCache.get_entry method) and still fresh.
+        Else it returns None.
+        """
+
+        if not self.harvest_listing or post.listed_stats is None:
+            return
+
+        listed_at = post.listed_stats[0]
+
+        if entry is not None and listed_at <= entry[0]:
+            return
+
+        if not self.stats_cache.is_fresh(listed_at, post.date):
+            return
+
+        return post.listed_stats
+
+    def save_stats(self, posts_data: dict, posts_dates: dict, fetch_times=None):
+
+        """
+        This method saves freshly fetched TGStat data on posts to the stats cache and appends it to their history.
+        fetch_times may map links to when their data was fetched, the rest are saved as fetched right now.
+        """
+
+        now = time.time()
+        fetch_times = {post_link: (fetch_times or {}).get(post_link, now) for post_link in posts_data}
+
+        self.stats_cache.put_many(posts_data, posts_dates, fetch_times)
+        self.history_store.append_many(posts_data, fetch_times)
+
+    def get_cached_post_stats(self, post: Post):
+
+        """
+        This method returns raw TGStat data on a single post, reading it through the stats cache.
+
+        Posts come one by one here, so they can't be ranked: expired stats are refreshed while the budget lasts,
+        and carried forward after that. TGStat lists posts newest first, so the budget goes to the newest posts.
+        """
+
+        entry = self.stats_cache.get_entry(post.link)
+        listed_stats = self.usable_listed_stats(post, entry)
+
+        if listed_stats is not None:
+            self.save_stats({post.link: listed_stats[1]}, {post.link: post.date}, {post.link: listed_stats[0]})
+            return listed_stats[1]
+
+        if entry is None:
+            self.take_requests(1)
+        elif self.stats_cache.is_fresh(entry[0], post.date) or not self.take_requests(1):
+            return entry[1]
+
+        post_data = self.get_post_stats(post.link)
+        self.save_stats({post.link: post_data}, {post.link: post.date})
+
+        return post_data
+
+    @staticmethod
+    def fill_post_stats(post: Post, post_data: dict):
+
+        """
+        This method calculates share_per_view and reactions_per_view proportions from raw TGStat data on a post,
+        rounds them and saves them to the Post. A post with no views gets 0 for both.
+        Many posts at once are better filled in a batch (see calculate_posts_stats method).
+
+        Proportions are calculated by the same function as in a batch (see ratios in engagement module),
+        so a post gets exactly the same values either way and its row is not rewritten for nothing.
+        """
+
+        views_count = post_data["viewsCount"]
+
+        post.shares_per_view, post.reactions_per_view = ratios(
+            np.array([post_data["sharesCount"], post_data["reactionsCount"]], dtype=float),
+            np.array([views_count, views_count], dtype=float)
+        ).tolist()
+
+    @staticmethod
+    def fill_rankings(posts_dict: dict, table: EngagementTable):
+
+        """
+        This method saves to every Post where it stands among the posts of the table: percentile ranks
+        and z-scores of its share_per_view and reactions_per_view proportions, rounded to two decimals.
+        Rows of the table should come in the same order as posts.
+        """
+
+        rankings = [table.percentile_ranks("shares_per_view"), table.z_scores("shares_per_view"),
+                    table.percentile_ranks("reactions_per_view"), table.z_scores("reactions_per_view")]
+        rankings = [[round(value, 2) for value in ranks.tolist()] for ranks in rankings]
+
+        for post, *post_rankings in zip(posts_dict.values(), *rankings):
+            (post.shares_per_view_percentile, post.shares_per_view_z_score,
+             post.reactions_per_view_percentile, post.reactions_per_view_z_score) = post_rankings
+
+    def split_by_source(self, posts_dict: dict):
+
+        """
+        This method sorts posts by where their stats are going to come from and returns three dicts:
+
+        1. Raw TGStat data on posts that don't need a request, harvested from the listing or fresh in the cache.
+        2. Counters harvested from the listing, as tuples of when the post was listed and its stats.
+        3. Posts whose stats have to be requested or carried forward, mapped to tuples of post date
+        and cache entry (see request_planner module).
+        """
+
+        posts_data = {}
+        harvested = {}
+        stale_posts = {}
+
+        for post_link, post in posts_dict.items():
+            entry = self.stats_cache.get_entry(post_link)
+            listed_stats = self.usable_listed_stats(post, entry)
+
+            if listed_stats is not None:
+                posts_data[post_link] = listed_stats[1]
+                harvested[post_link] = listed_stats
+            elif entry is not None and self.stats_cache.is_fresh(entry[0], post.date):
+                posts_data[post_link] = entry[1]
+            else:
+                stale_posts[post_link] = (post.date, entry)
+
+        return posts_data, harvested, stale_posts
+
+    def plan_posts_stats(self, posts_dict: dict, planned_links=()):
+
+        """
+        This method is a dry run of calculate_posts_stats: it decides which posts would have their stats requested
+        from TGStat, takes them from the budget, but doesn't request or save anything.
+
+        planned_links are posts an earlier step of the same run would have requested already,
+        so they'd be fresh in the cache by now.
+
+        It returns a dict of post links and posts, and a list of links that would be requested.
+        Posts whose stats are known (from the listing, the cache, or carried forward) get their ratios,
+        posts that would be requested are left with None, since we can't know them without a request.
+        """
+
+        if posts_dict == {}:
+            return {}, []
+
+        posts_data, harvested, stale_posts = self.split_by_source(posts_dict)
+
+        for post_link in planned_links:
+            stale_posts.pop(post_link, None)
+
+        links_to_fetch, links_to_carry = plan_requests(stale_posts, self.requests_left)
+        self.take_requests(len(links_to_fetch))
+
+        for post_link in links_to_carry:
+            posts_data[post_link] = stale_posts[post_link][1][1]
+
+        for post_link, post in posts_dict.items():
+            if post_link in posts_data:
+                self.fill_post_stats(post, posts_data[post_link])
+
+        return dict(posts_dict), links_to_fetch
+
     def calculate_posts_stats(self, posts_dict: dict):
 
         """
         This method takes data from posts dict and gets data on every post by calling the TGStat API.
 
-        It then calculates share_per_view and reactions_per_view proportions, rounds them and
-        returns them in a dictionary together with post link, date and text.
+        Data is read through the stats cache first, only posts that are missing from it or whose stats have expired
+        are requested. If that's more than the budget of this run allows, posts whose stats are expected to have
+        moved the most are requested, the rest carry their previous values forward (see request_planner module).
+        Calls are made concurrently by a pool of "max_workers" workers, all of them sharing
+        the rate limiter. Results are collected in the same order the posts come in.
+
+        It then calculates share_per_view and reactions_per_view proportions of every post in one batch
+        (see engagement module), along with where every post stands among the others (see fill_rankings method),
+        saves them to every Post and returns a dictionary of post links and posts.
         """
 
         if posts_dict == {}:
             return
 
         post_stats = {}
+        posts_data, harvested, stale_posts = self.split_by_source(posts_dict)
+
+        if harvested:
+            self.save_stats({post_link: stats for post_link, (listed_at, stats) in harvested.items()},
+                            {post_link: posts_dict[post_link].date for post_link in harvested},
+                            {post_link: listed_at for post_link, (listed_at, stats) in harvested.items()})
+
+        links_to_fetch, links_to_carry = plan_requests(stale_posts, self.requests_left)
+        self.take_requests(len(links_to_fetch))
+
+        for post_link in links_to_carry:
+            posts_data[post_link] = stale_posts[post_link][1][1]
 
-        for post_link, post_date_and_text in posts_dict.items():
+        if links_to_fetch:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                fetched_data = dict(zip(links_to_fetch, executor.map(self.get_post_stats, links_to_fetch)))
 
-            get_posts_stats_params = {
-                "token": os.environ["TG_STATS_TOKEN"],
-                "postId": post_link,
-            }
+            self.save_stats(fetched_data, {post_link: posts_dict[post_link].date for post_link in links_to_fetch})
+            posts_data.update(fetched_data)
 
-            post_response = requests.get(url=self.posts_stats_endpoint, params=get_posts_stats_params)
-            post_data = post_response.json()["response"]
+        print(f"Post stats: {len(harvested)} taken from listing, "
+              f"{len(posts_dict) - len(stale_posts) - len(harvested)} taken from cache, "
+              f"{len(links_to_fetch)} requested, {len(links_to_carry)} carried forward")
 
-            views_count = post_data["viewsCount"]
-            shares_count = post_data["sharesCount"]
-            reactions_count = post_data["reactionsCount"]
+        table = EngagementTable.from_posts_data({post_link: posts_data[post_link] for post_link in posts_dict})
 
-            share_per_view = round(shares_count / views_count * 100, 2)
-            reaction_per_view = round(reactions_count / views_count * 100, 2)
+        for post, shares_per_view, reactions_per_view in zip(posts_dict.values(),
+                                                             table.shares_per_view.tolist(),
+                                                             table.reactions_per_view.tolist()):
+            post.shares_per_view = shares_per_view
+            post.reactions_per_view = reactions_per_view
+            post_stats[post.link] = post
 
-            post_stats[f"{post_link}"] = {
-                "shares_per_view": share_per_view,
-                "reactions_per_view": reaction_per_view,
-                "date": post_date_and_text["date"],
-                "text": post_date_and_text["text"],
-            }
+        self.fill_rankings(posts_dict, table)
 
         return post_stats
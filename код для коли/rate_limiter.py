@@ -0,0 +1,275 @@
+import datetime as dt
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+# =========== Request budgets for every endpoint we call ===========
+
+# Each budget is (starting requests per second, max requests per second) and applies to every endpoint whose
+# key starts with the given prefix. Every endpoint gets a bucket of its own, so TGStat listing, TGStat post stats
+# and each Sheety tab are throttled separately. Endpoints that match none of the prefixes get DEFAULT_BUDGET.
+BUDGETS = {
+    "api.tgstat.ru/channels/posts": (1, 5),
+    "api.tgstat.ru/posts/stat": (5, 20),
+    "api.sheety.co": (2, 10),
+}
+DEFAULT_BUDGET = (1, 5)
+
+# Statuses which mean the service is overloaded and we should slow down and try again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# 429 means the request hasn't been processed, so any request is repeated after it. A 5xx may come after the service
+# has already done the work, so only requests that do the same thing when sent twice are repeated after it.
+# A repeated POST adds a row twice, and a repeated DELETE removes the row that has moved up into the place
+# of the deleted one.
+REPEATABLE_METHODS = {"GET", "PUT"}
+
+
+class QuotaExceeded(Exception):
+    """
+    Raised when a request would go over the quota of its service.
+    """
+
+
+def endpoint_key(url: str):
+
+    """
+    This function turns a request URL into an endpoint key: host and path without the trailing row id,
+    so that e.g. every ".../daily/15" request falls into the same bucket as ".../daily".
+    """
+
+    parts = urlsplit(url)
+    path = parts.path.rstrip("/")
+    head, _, tail = path.rpartition("/")
+
+    if tail.isdigit():
+        path = head
+
+    return f"{parts.netloc}{path}"
+
+
+def parse_retry_after(value):
+
+    """
+    This function reads a Retry-After header, which is either a number of seconds or an HTTP date,
+    and returns the number of seconds to wait. If the header is missing or malformed, it returns None.
+    """
+
+    if value is None:
+        return
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return
+
+    return max(0.0, (retry_at - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+
+# =========== A token bucket for a single endpoint ===========
+class TokenBucket:
+
+    def __init__(self, rate: float, max_rate: float, burst=1):
+
+        self.rate = rate
+        self.min_rate = rate / 8
+        self.max_rate = max_rate
+        # Healthy responses raise the rate by a tenth of the starting rate, overloads halve it
+        self.rate_step = rate / 10
+        self.burst = burst
+
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.failures = 0
+
+    def reserve(self):
+
+        """
+        This method takes a token from the bucket and returns how long the caller has to wait before using it.
+
+        Tokens may go below zero: every caller books its own slot in the future, so waiting callers
+        are let through one by one, evenly spaced at the current rate.
+        """
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+
+        return max(0.0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def healthy(self):
+        self.failures = 0
+        self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+    def overloaded(self, retry_after=None):
+
+        """
+        This method halves the rate and blocks the bucket for Retry-After seconds, if the service told us
+        how long to wait, or for an exponentially growing delay with a bit of jitter if it didn't.
+        """
+
+        self.failures += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+
+        if retry_after is None:
+            retry_after = min(60.0, 2 ** self.failures) * random.uniform(0.5, 1.0)
+
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+
+# =========== Now we create a class that throttles requests to every endpoint we call ===========
+class RateLimiter:
+
+    def __init__(self, budgets=None, default_budget=DEFAULT_BUDGET, max_retries=3):
+
+        self.budgets = budgets if budgets is not None else BUDGETS
+        self.default_budget = default_budget
+        self.max_retries = max_retries
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+        # Number of requests left for services with a quota, by endpoint key prefix (see set_quota method),
+        # and the quotas they started with
+        self.quotas = {}
+        self.quota_limits = {}
+
+        # Total time callers spent waiting for their turn, in seconds, and number of requests repeated
+        self.slept = 0.0
+        self.retries = 0
+
+    def bucket(self, key: str):
+
+        """
+        This method returns a bucket for an endpoint key, creating it from the longest matching budget if needed.
+        Should be called under the lock.
+        """
+
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(*self.budget(key))
+
+        return self.buckets[key]
+
+    def budget(self, key: str):
+
+        """
+        This method returns the budget of an endpoint key: (starting requests per second, max requests per second)
+        of the longest matching prefix, or the default budget if none of them match.
+        """
+
+        prefixes = [prefix for prefix in self.budgets if key.startswith(prefix)]
+
+        if prefixes:
+            return self.budgets[max(prefixes, key=len)]
+
+        return self.default_budget
+
+    def set_quota(self, prefix: str, requests_left: int):
+
+        """
+        This method limits the number of requests to every endpoint whose key starts with prefix,
+        e.g. "api.tgstat.ru". The quota is shared by everyone using this limiter.
+        """
+
+        with self._lock:
+            self.quotas[prefix] = requests_left
+            self.quota_limits[prefix] = requests_left
+
+    def reset_quotas(self):
+
+        """
+        This method gives every quota back the number of requests it was set to. Quotas are per run,
+        so a long-running process resets them before every run.
+        """
+
+        with self._lock:
+            self.quotas = dict(self.quota_limits)
+
+    def reset_counters(self):
+
+        """
+        This method sets time spent waiting and number of requests repeated back to zero,
+        so a long-running process reports them per run.
+        """
+
+        with self._lock:
+            self.slept = 0.0
+            self.retries = 0
+
+    def acquire(self, url: str):
+
+        """
+        This method blocks until a request to url is allowed by its endpoint budget.
+        If the request would go over the quota of its service, the method raises QuotaExceeded.
+        """
+
+        key = endpoint_key(url)
+
+        with self._lock:
+            for prefix, requests_left in self.quotas.items():
+                if key.startswith(prefix):
+                    if requests_left <= 0:
+                        raise QuotaExceeded(f"Quota for {prefix} is used up")
+                    self.quotas[prefix] = requests_left - 1
+
+            wait_time = self.bucket(key).reserve()
+            self.slept += wait_time
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def report(self, url: str, response):
+
+        """
+        This method adjusts the budget of an endpoint according to the response we've got from it.
+
+        429 and 5xx responses slow the endpoint down and honour Retry-After, any other response speeds it up.
+        """
+
+        with self._lock:
+            bucket = self.bucket(endpoint_key(url))
+
+            if response.status_code in RETRY_STATUSES:
+                bucket.overloaded(parse_retry_after(response.headers.get("Retry-After")))
+            else:
+                bucket.healthy()
+
+    def call(self, url: str, send, method="GET"):
+
+        """
+        This method makes a request through the limiter: it waits for its turn, calls send() (a function that
+        makes the request and returns a response) and reports the response.
+
+        If the service is overloaded, the request is repeated up to max_retries times: after 429 whatever its method,
+        after 5xx only if its method is in REPEATABLE_METHODS. The last response is returned either way,
+        so callers still check its status.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                with self._lock:
+                    self.retries += 1
+
+            self.acquire(url)
+            response = send()
+            self.report(url, response)
+
+            if response.status_code not in RETRY_STATUSES:
+                break
+            if response.status_code != 429 and method not in REPEATABLE_METHODS:
+                break
+
+        return response
+
+
+# The limiter shared by StatCalculator and DataManager, unless they're given another one
+default_rate_limiter = RateLimiter()
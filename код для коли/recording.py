@@ -0,0 +1,225 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import dates
+from rate_limiter import endpoint_key
+from transport import Transport, Response, default_transport
+
+
+# =========== Record/replay settings ===========
+
+# Request parameters and environment variables that hold secrets. They never get into a recording:
+# parameters are dropped, values of the variables are replaced with their names.
+SECRET_PARAMS = {"token"}
+SECRET_ENV = ("SHEETY_USERNAME",)
+
+# Response headers worth keeping in a recording (the rate limiter reads Retry-After)
+KEPT_HEADERS = ("Content-Type", "Retry-After")
+
+
+class ReplayMiss(Exception):
+    """
+    Raised when a request has never been recorded, so there's nothing to answer it with.
+    """
+
+
+def mask_url(url: str):
+    for name in SECRET_ENV:
+        if os.environ.get(name):
+            url = url.replace(os.environ[name], name)
+    return url
+
+
+def request_key(method: str, url: str, params=None, json_body=None):
+
+    """
+    This function returns a key that identifies a request in a recording, without any secrets in it.
+    Requests with the same method, URL, parameters and body get the same key.
+    """
+
+    params = {name: value for name, value in (params or {}).items() if name not in SECRET_PARAMS}
+
+    return json.dumps([method, mask_url(url), params, json_body], sort_keys=True, default=str)
+
+
+def pin_today(now: datetime.datetime):
+
+    """
+    This function sets the date every module works with. A replay has to run on the same date as the recording,
+    or the time windows of TGStat requests wouldn't match.
+    """
+
+    dates.set_today(now)
+
+
+# =========== A transport that writes every request it makes to a file ===========
+class RecordingTransport(Transport):
+
+    """
+    The recording is a JSON Lines file: the first line holds the date the run has been recorded on,
+    every next one holds a request and the response it got, in the order responses arrived.
+    """
+
+    def __init__(self, path: str, now=None, **kwargs):
+
+        super().__init__(**kwargs)
+
+        self.now = now or datetime.datetime.today()
+        self._lock = threading.Lock()
+        self.recording = open(path, "w", encoding="utf-8")
+        self.write_line({"recorded_on": self.now.isoformat()})
+
+    def write_line(self, line: dict):
+        with self._lock:
+            self.recording.write(json.dumps(line, ensure_ascii=False) + "\n")
+            self.recording.flush()
+
+    def send(self, method: str, url: str, **kwargs):
+
+        started = time.monotonic()
+        response = super().send(method, url, **kwargs)
+
+        self.write_line({
+            "key": request_key(method, url, kwargs.get("params"), kwargs.get("json")),
+            "status": response.status_code,
+            "headers": {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers},
+            "body": response.text,
+            "elapsed": time.monotonic() - started,
+        })
+
+        return response
+
+    def close(self):
+        super().close()
+        self.recording.close()
+
+
+# =========== A transport that answers requests from a recording, without going online ===========
+class ReplayTransport(Transport):
+
+    """
+    Every request is answered with the next recorded response to the same request, so a run that makes
+    the same requests gets the same responses in the same order. Once the recorded responses to a request
+    run out, the last one is repeated. A request that has never been recorded raises ReplayMiss.
+
+    latency          - None to answer at once, a number of seconds to wait before every answer,
+                       or "recorded" to wait as long as the live service did
+    rate_limit       - if set, every endpoint answers at most rate_limit requests per second
+                       and answers the rest with 429 and Retry-After, like an overloaded service would
+    """
+
+    def __init__(self, path: str, latency=None, rate_limit=None, **kwargs):
+
+        super().__init__(**kwargs)
+
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+
+        self.responses = {}
+        with open(path, encoding="utf-8") as recording:
+            header = json.loads(recording.readline())
+            self.now = datetime.datetime.fromisoformat(header["recorded_on"])
+
+            for line in recording:
+                entry = json.loads(line)
+                self.responses.setdefault(entry["key"], []).append(entry)
+
+        # How many responses to every request have been served, and when every endpoint takes the next request
+        self.served = {}
+        self.next_allowed = {}
+
+    def throttled(self, url: str):
+
+        if self.rate_limit is None:
+            return
+
+        key = endpoint_key(url)
+        now = time.monotonic()
+
+        with self._lock:
+            wait_time = self.next_allowed.get(key, 0.0) - now
+            if wait_time > 0:
+                return wait_time
+            self.next_allowed[key] = now + 1 / self.rate_limit
+
+    def send(self, method: str, url: str, **kwargs):
+
+        wait_time = self.throttled(url)
+        if wait_time is not None:
+            return make_response(url, {"status": 429, "headers": {"Retry-After": f"{wait_time:.3f}"}, "body": ""})
+
+        key = request_key(method, url, kwargs.get("params"), kwargs.get("json"))
+
+        with self._lock:
+            entries = self.responses.get(key)
+            if not entries:
+                raise ReplayMiss(f"{method} {mask_url(url)} {kwargs.get('params')} has not been recorded")
+
+            served = self.served.get(key, 0)
+            self.served[key] = served + 1
+            entry = entries[min(served, len(entries) - 1)]
+
+        if self.latency == "recorded":
+            time.sleep(entry["elapsed"])
+        elif self.latency:
+            time.sleep(self.latency)
+
+        return make_response(url, entry)
+
+
+def make_response(url: str, entry: dict):
+
+    """
+    This function turns a recorded response into a Response, as if it has just come from the service.
+    """
+
+    raw = requests.Response()
+    raw.url = url
+    raw.status_code = entry["status"]
+    raw.reason = ""
+    raw.headers = CaseInsensitiveDict(entry["headers"])
+    raw.encoding = "utf-8"
+    raw._content = entry["body"].encode("utf-8")
+
+    return Response(raw)
+
+
+def transport_from_env():
+
+    """
+    This function returns the transport a run should use:
+
+    REPLAY_FROM=path       - answer every request from a recording, offline. REPLAY_LATENCY (seconds or "recorded")
+                             and REPLAY_RATE_LIMIT (requests per second per endpoint) simulate a live service
+    RECORD_TO=path         - make live requests and record them to path
+    neither                - the shared live transport
+
+    Recording and replay both pin today's date (see pin_today function). For a replay to make exactly
+    the requests that have been recorded, run it with the same caches the recording has started with,
+    e.g. a fresh TGSTAT_CACHE_PATH file for both.
+    """
+
+    if os.environ.get("REPLAY_FROM"):
+        latency = os.environ.get("REPLAY_LATENCY")
+        if latency not in (None, "recorded"):
+            latency = float(latency)
+
+        rate_limit = os.environ.get("REPLAY_RATE_LIMIT")
+
+        transport = ReplayTransport(os.environ["REPLAY_FROM"],
+                                    latency=latency,
+                                    rate_limit=float(rate_limit) if rate_limit else None)
+    elif os.environ.get("RECORD_TO"):
+        transport = RecordingTransport(os.environ["RECORD_TO"])
+    else:
+        return default_transport
+
+    pin_today(transport.now)
+    return transport
@@ -0,0 +1,64 @@
+import datetime as dt
+import time
+
+
+# =========== How much stats of a post are expected to move ===========
+
+# Until a post has been fetched twice, we don't know how fast its ratios move, so we guess from its age:
+# a post of age 0 is expected to move by PRIOR_CHANGE_PER_HOUR percentage points per hour,
+# and the expectation halves every PRIOR_HALF_LIFE of post age.
+PRIOR_CHANGE_PER_HOUR = 1.0
+PRIOR_HALF_LIFE = dt.timedelta(days=1)
+
+
+def expected_change(post_date: dt.datetime, fetched_at: float, change_per_hour, now=None):
+
+    """
+    This function estimates how far the ratios of a post have moved since its stats were fetched
+    (fetched_at, unix timestamp), in percentage points.
+
+    change_per_hour is how fast they moved between the last two fetches, or None if we don't know yet.
+    """
+
+    now = now or time.time()
+
+    if change_per_hour is None:
+        post_age = dt.timedelta(seconds=max(0.0, now - post_date.timestamp()))
+        change_per_hour = PRIOR_CHANGE_PER_HOUR * 0.5 ** (post_age / PRIOR_HALF_LIFE)
+
+    return change_per_hour * max(0.0, now - fetched_at) / 3600
+
+
+def plan_requests(stale_posts: dict, budget=None, now=None):
+
+    """
+    This function decides which posts get their stats requested from TGStat, when we can't afford them all.
+
+    stale_posts maps links of posts whose cached stats have expired (or that are not cached at all)
+    to tuples of post date and cache entry (see StatsCache.get_entry method), or None for posts never fetched.
+    budget is the number of requests we can make, None for no limit.
+
+    Posts that have never been fetched have nothing to fall back on, so they're always requested.
+    The rest of the budget goes to posts whose stats are expected to have moved the most,
+    the remaining ones carry their previous values forward.
+
+    The function returns two lists of links: posts to request, and posts to carry forward.
+    """
+
+    never_fetched = [post_link for post_link, (post_date, entry) in stale_posts.items() if entry is None]
+    cached = [post_link for post_link, (post_date, entry) in stale_posts.items() if entry is not None]
+
+    if budget is None or len(stale_posts) <= budget:
+        return never_fetched + cached, []
+
+    now = now or time.time()
+
+    cached.sort(key=lambda post_link: expected_change(stale_posts[post_link][0],
+                                                      stale_posts[post_link][1][0],
+                                                      stale_posts[post_link][1][2],
+                                                      now),
+                reverse=True)
+
+    refreshes = max(0, budget - len(never_fetched))
+
+    return never_fetched + cached[:refreshes], cached[refreshes:]
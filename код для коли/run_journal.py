@@ -0,0 +1,163 @@
+import sqlite3
+import datetime as dt
+import json
+import os
+import threading
+import time
+
+from post import Post
+
+
+# =========== Posts are saved to the journal as plain dicts ===========
+def post_record(post: Post):
+
+    """
+    This function turns a Post into a dict that can be saved as JSON.
+    """
+
+    return {
+        "link": post.link,
+        "date": post.date.timestamp(),
+        "text": post.text,
+        "group_id": post.group_id,
+        "listed_stats": post.listed_stats,
+        "shares_per_view": post.shares_per_view,
+        "reactions_per_view": post.reactions_per_view,
+        "shares_per_view_percentile": post.shares_per_view_percentile,
+        "shares_per_view_z_score": post.shares_per_view_z_score,
+        "reactions_per_view_percentile": post.reactions_per_view_percentile,
+        "reactions_per_view_z_score": post.reactions_per_view_z_score,
+    }
+
+
+def post_from_record(record: dict):
+
+    """
+    This function creates a Post from a dict saved by post_record function.
+    Rankings are missing from records saved before posts were ranked, so they're left empty.
+    """
+
+    post = Post(link=record["link"],
+                date=dt.datetime.fromtimestamp(record["date"]),
+                text=record["text"],
+                group_id=record["group_id"],
+                listed_stats=tuple(record["listed_stats"]) if record["listed_stats"] is not None else None)
+    post.shares_per_view = record["shares_per_view"]
+    post.reactions_per_view = record["reactions_per_view"]
+    post.shares_per_view_percentile = record.get("shares_per_view_percentile")
+    post.shares_per_view_z_score = record.get("shares_per_view_z_score")
+    post.reactions_per_view_percentile = record.get("reactions_per_view_percentile")
+    post.reactions_per_view_z_score = record.get("reactions_per_view_z_score")
+
+    return post
+
+
+# =========== Now we create a class that remembers how far a run of a channel has got ===========
+class RunJournal:
+
+    """
+    A run of a channel goes through steps that cost API calls: the listing is fetched, stats are calculated,
+    then every tab is written to every sink. The journal saves the result of every step as soon as it's done,
+    so if the run fails, the next run of the same day picks up where it has stopped
+    instead of paying for every call again.
+
+    Steps are kept in a SQLite file (RUN_JOURNAL_PATH, run_journal.sqlite3 by default), keyed by channel.
+    Once the run is done, its steps are dropped. Steps left by a run of another day are dropped too,
+    since the windows of posts have moved since then.
+    """
+
+    def __init__(self, channel_id: str, run_day: str, path=None):
+
+        self.channel_id = channel_id
+        self.run_day = run_day
+        self.path = path or os.environ.get("RUN_JOURNAL_PATH", "run_journal.sqlite3")
+
+        # Sinks are written from worker threads, so the connection is shared under a lock
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+
+        with self._lock, self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS run_steps (
+                    channel_id TEXT NOT NULL,
+                    step TEXT NOT NULL,
+                    run_day TEXT NOT NULL,
+                    done_at REAL NOT NULL,
+                    data TEXT,
+                    PRIMARY KEY (channel_id, step)
+                )
+                """
+            )
+            self.connection.execute("DELETE FROM run_steps WHERE channel_id = ? AND run_day != ?",
+                                    (self.channel_id, self.run_day))
+
+    def has(self, step: str):
+
+        """
+        This method checks if a step has been done by this run or by a failed run of the same day.
+        """
+
+        with self._lock:
+            return self.connection.execute("SELECT 1 FROM run_steps WHERE channel_id = ? AND step = ?",
+                                           (self.channel_id, step)).fetchone() is not None
+
+    def load(self, step: str):
+
+        """
+        This method returns whatever was saved with a step, or None if the step hasn't been done.
+        """
+
+        with self._lock:
+            row = self.connection.execute("SELECT data FROM run_steps WHERE channel_id = ? AND step = ?",
+                                          (self.channel_id, step)).fetchone()
+
+        if row is None or row[0] is None:
+            return
+
+        return json.loads(row[0])
+
+    def save(self, step: str, data=None):
+
+        """
+        This method marks a step as done and saves its result (anything JSON can hold), if it has one.
+        """
+
+        with self._lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO run_steps VALUES (?, ?, ?, ?, ?)",
+                                    (self.channel_id, step, self.run_day, time.time(),
+                                     json.dumps(data, ensure_ascii=False) if data is not None else None))
+
+    def save_posts(self, step: str, posts_dict):
+
+        """
+        This method marks a step as done and saves a dict of posts (links mapped to Posts) as its result.
+        A step that ended with no posts at all (None) is saved too.
+        """
+
+        self.save(step, [post_record(post) for post in posts_dict.values()] if posts_dict is not None else None)
+
+    def load_posts(self, step: str):
+
+        """
+        This method returns the dict of posts saved with a step, in the order they were saved.
+        """
+
+        records = self.load(step)
+
+        if records is None:
+            return
+
+        return {record["link"]: post_from_record(record) for record in records}
+
+    def finish(self):
+
+        """
+        This method drops every step of the run, once the run is done.
+        """
+
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM run_steps WHERE channel_id = ?", (self.channel_id,))
+
+    def close(self):
+        self.connection.close()
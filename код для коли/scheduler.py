@@ -0,0 +1,247 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import dates
+import posts_getter
+import pipeline
+import sinks
+from engagement import EngagementTable
+from metrics import TOP_POSTS
+from run_journal import RunJournal
+from transport import default_transport
+
+
+def streaming_mode():
+
+    """
+    If the STREAMING environment variable is set to 1, daily posts are streamed from TGStat pages to the sheet,
+    so stats and sheet writes for the first posts overlap with fetching later pages (see pipeline module).
+    """
+
+    return os.environ.get("STREAMING") == "1"
+
+
+def report_top_posts(stats_calculator, tab: str, post_stats):
+
+    """
+    This function saves links of the best posts of a tab by every ratio (TOP_POSTS of them)
+    to the run report of the transport's metrics (see metrics module).
+    """
+
+    if not post_stats:
+        return
+
+    table = EngagementTable.from_posts(post_stats)
+    stats_calculator.transport.metrics.record_top_posts(
+        stats_calculator.channel_id, tab,
+        {name: table.top(name, n=TOP_POSTS) for name in ("shares_per_view", "reactions_per_view")}
+    )
+
+
+def fetch_listing(stats_calculator, journal=None):
+
+    """
+    This function gets daily and monthly posts of a channel. If a failed run of the same day has already got them,
+    they're taken from the run journal instead. If an API call fails, the function raises ListingError.
+    """
+
+    # Monthly posts are saved last, so if they're in the journal, daily ones are there too
+    if journal is not None and journal.has("listing: monthly"):
+        stats_calculator.daily_posts = journal.load_posts("listing: daily")
+        stats_calculator.monthly_posts = journal.load_posts("listing: monthly")
+        print(f"{stats_calculator.channel_id}: listing taken from the run journal")
+        return
+
+    # On results days daily and monthly windows overlap, so both are listed in one go
+    daily_posts, monthly_posts = stats_calculator.get_daily_and_monthly_posts_data()
+
+    if daily_posts is None or monthly_posts is None:
+        raise posts_getter.ListingError(f"Couldn't get posts of {stats_calculator.channel_id}")
+
+    if journal is not None:
+        journal.save_posts("listing: daily", daily_posts)
+        journal.save_posts("listing: monthly", monthly_posts)
+
+
+def finish_daily(stats_calculator, channel_sinks: list, journal=None):
+
+    """
+    This function takes daily posts that have already been fetched, cuts their text, orders them,
+    calculates their stats and writes them to "daily" tab of every sink.
+
+    If a failed run of the same day has already calculated the stats, they're taken from the run journal.
+    """
+
+    metrics = stats_calculator.transport.metrics
+
+    if journal is not None and journal.has("daily stats"):
+        post_stats = journal.load_posts("daily stats")
+        stats_calculator.daily_posts = post_stats or {}
+    else:
+        with metrics.stage("text cut"):
+            stats_calculator.cut_text(stats_calculator.daily_posts)
+        with metrics.stage("ordering"):
+            stats_calculator.order_post_chronologically("daily")
+        with metrics.stage("stats fetch"):
+            post_stats = stats_calculator.calculate_posts_stats(stats_calculator.daily_posts)
+
+        if journal is not None:
+            journal.save_posts("daily stats", post_stats)
+
+    report_top_posts(stats_calculator, "daily", post_stats)
+    sinks.write_to_sinks(channel_sinks, "daily", post_stats, metrics, journal)
+
+
+def finish_results(stats_calculator, channel_sinks: list, journal=None):
+
+    """
+    This function takes monthly posts that have already been fetched, cuts their text, orders them,
+    calculates their stats and writes them to "results" tab of every sink.
+
+    If a failed run of the same day has already calculated the stats, they're taken from the run journal.
+    """
+
+    metrics = stats_calculator.transport.metrics
+
+    if journal is not None and journal.has("results stats"):
+        post_stats = journal.load_posts("results stats")
+        stats_calculator.monthly_posts = post_stats or {}
+    else:
+        with metrics.stage("text cut"):
+            stats_calculator.cut_text(stats_calculator.monthly_posts)
+        with metrics.stage("ordering"):
+            stats_calculator.order_post_chronologically("monthly")
+        with metrics.stage("stats fetch"):
+            post_stats = stats_calculator.calculate_posts_stats(stats_calculator.monthly_posts)
+
+        if journal is not None:
+            journal.save_posts("results stats", post_stats)
+
+    report_top_posts(stats_calculator, "results", post_stats)
+    sinks.write_to_sinks(channel_sinks, "results", post_stats, metrics, journal)
+
+
+def sync_daily(stats_calculator, channel_sinks: list, journal=None):
+
+    """
+    This function brings "daily" tab of a channel up to date in every sink.
+
+    In streaming mode posts are streamed to the sheet, and the other sinks get them all at once when the stream ends.
+    Without a Sheety sink there's nothing to stream to, so posts are processed as usual.
+    If a failed run of the same day has got as far as stats, they're written to every sink without streaming.
+    """
+
+    sheety = sinks.sheety_sink(channel_sinks)
+    resumed = journal is not None and journal.has("daily stats")
+
+    if streaming_mode() and sheety is not None and not resumed:
+        post_stats = pipeline.StreamingPipeline(stats_calculator, sheety.data_manager).run()
+        sheety.data_manager.post_stats = post_stats
+        report_top_posts(stats_calculator, "daily", post_stats)
+
+        if journal is not None:
+            journal.save_posts("daily stats", post_stats)
+            journal.save(sinks.journal_step("daily", sheety))
+
+        other_sinks = [sink for sink in channel_sinks if sink is not sheety]
+        if other_sinks:
+            sinks.write_to_sinks(other_sinks, "daily", post_stats, stats_calculator.transport.metrics, journal)
+        return
+
+    if not resumed and stats_calculator.get_daily_posts_data() is None:
+        raise posts_getter.ListingError(f"Couldn't get daily posts of {stats_calculator.channel_id}")
+
+    finish_daily(stats_calculator, channel_sinks, journal)
+
+
+def sync_results(stats_calculator, channel_sinks: list, journal=None):
+
+    """
+    This function brings "results" tab of a channel up to date in every sink. Monthly results are only collected
+    on 14th, 15th and 16th, on any other day the sheet holds a placeholder and local copies keep the last results.
+    """
+
+    resumed = journal is not None and journal.has("results stats")
+
+    if not resumed and stats_calculator.get_monthly_posts_data() is None:
+        raise posts_getter.ListingError(f"Couldn't get monthly posts of {stats_calculator.channel_id}")
+
+    finish_results(stats_calculator, channel_sinks, journal)
+
+
+def run_channel(channel: dict, transport=None):
+
+    """
+    This function gets posts of a single channel, calculates their stats and updates "daily" and "results" tabs
+    in every sink of the channel (see sinks module).
+
+    Every step is saved to the run journal as soon as it's done, so if the run fails,
+    the next run of the same day resumes from the last finished step (see run_journal module).
+    """
+
+    stats_calculator = posts_getter.StatCalculator(channel_id=channel["channel_id"],
+                                                   transport=transport,
+                                                   incremental=True,
+                                                   stats_budget=channel.get("stats_request_budget"),
+                                                   harvest_listing=channel.get("harvest_listing_stats", False))
+    channel_sinks = sinks.make_sinks(channel, transport=transport)
+    journal = RunJournal(channel["channel_id"], run_day=dates.today.date().isoformat())
+
+    try:
+        if streaming_mode():
+            sync_daily(stats_calculator, channel_sinks, journal)
+            sync_results(stats_calculator, channel_sinks, journal)
+        else:
+            fetch_listing(stats_calculator, journal)
+            finish_daily(stats_calculator, channel_sinks, journal)
+            finish_results(stats_calculator, channel_sinks, journal)
+
+        journal.finish()
+
+    finally:
+        for sink in channel_sinks:
+            sink.close()
+        journal.close()
+
+
+def run_channels(config: dict, transport=None):
+
+    """
+    This function runs every channel from the config on a pool of workers, "max_parallel_channels" at a time.
+
+    All channels share one transport, so they share connection pools, rate budgets of every endpoint
+    and the TGStat quota, if the config sets one. A failure in one channel doesn't stop the others.
+    The function returns a dict of channel ids that have failed, mapped to their errors.
+    """
+
+    transport = transport if transport is not None else default_transport
+
+    if config.get("tgstat_quota") is not None:
+        transport.rate_limiter.set_quota("api.tgstat.ru", config["tgstat_quota"])
+
+    return run_on_pool(config, lambda channel: run_channel(channel, transport))
+
+
+def run_on_pool(config: dict, job):
+
+    """
+    This function calls job(channel) for every channel from the config on a pool of workers,
+    "max_parallel_channels" at a time, and returns a dict of channel ids that have failed, mapped to their errors.
+    """
+
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=config["max_parallel_channels"]) as executor:
+        futures = {executor.submit(job, channel): channel["channel_id"] for channel in config["channels"]}
+
+        for future in as_completed(futures):
+            channel_id = futures[future]
+            try:
+                future.result()
+            except Exception as error:
+                print(f"{channel_id} failed: {error!r}")
+                failures[channel_id] = error
+            else:
+                print(f"{channel_id} done")
+
+    return failures
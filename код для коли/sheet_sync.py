@@ -0,0 +1,141 @@
+import bisect
+
+
+# =========== Here we plan how to bring a sheet in line with post stats using as few Sheety requests as possible ===========
+
+# Sheety identifies rows by their number in the sheet, so row ids start with 2 (row 1 is the header).
+# When a row is deleted, every row below it moves one row up and its id decreases by one.
+# Instead of asking Sheety for new ids after every deletion, we work them out locally.
+
+
+# Fields we write for every post. Sheety names columns in camelCase.
+ROW_FIELDS = ("postPreview", "postUrl", "postDate", "sharesPerView", "reactionsPerView")
+
+
+def sheet_row(post):
+
+    """
+    This function turns a Post with calculated stats into a row of the sheet: a dict of column names and values.
+    """
+
+    return {
+        "postPreview": post.text,
+        "postUrl": post.link,
+        "postDate": post.date.strftime("%d.%m.%y"),
+        "sharesPerView": post.shares_per_view,
+        "reactionsPerView": post.reactions_per_view,
+    }
+
+
+def same_value(sheet_value, value):
+
+    """
+    This function checks if a value read from the sheet is the same as a value we're about to write.
+
+    Google Sheets may hand numbers back as strings or drop trailing zeros, so numbers are compared as numbers.
+    """
+
+    if isinstance(value, (int, float)):
+        try:
+            return float(sheet_value) == float(value)
+        except (TypeError, ValueError):
+            return False
+
+    return str(sheet_value) == str(value)
+
+
+def row_changed(table_row: dict, row: dict, fields=ROW_FIELDS):
+
+    """
+    This function compares a row read from the sheet with a newly calculated one, field by field.
+    Only the listed fields are compared. If any of them differs, the row needs to be written.
+    """
+
+    return not all(same_value(table_row.get(field), row[field]) for field in fields)
+
+
+class SyncPlan:
+
+    def __init__(self, deletes: list, updates: dict, inserts: list, skipped=0):
+
+        # Ids of rows to delete, from the bottom of the sheet to the top. Deleting a row only shifts rows below it,
+        # so deleting bottom-up means ids of rows that are still to be deleted never change.
+        self.deletes = deletes
+
+        # Row ids (as they'll be after all deletions) mapped to links of posts that should be written to them
+        self.updates = updates
+
+        # Links of posts to append to the end of the sheet, in the order they should be added
+        self.inserts = inserts
+
+        # Number of rows that hold the right post with the same values already, so they're not written
+        self.skipped = skipped
+
+    def __repr__(self):
+        return (f"SyncPlan(deletes={len(self.deletes)}, updates={len(self.updates)}, "
+                f"inserts={len(self.inserts)}, skipped={self.skipped})")
+
+
+def shift_row_id(row_id: int, deleted_ids: list):
+
+    """
+    This function returns the id a row will have after rows with deleted_ids (sorted ascending) are deleted.
+    """
+
+    # Number of deleted rows above this one
+    return row_id - bisect.bisect_left(deleted_ids, row_id)
+
+
+def rows_after_sync(post_stats: dict):
+
+    """
+    This function returns rows a sheet holds after a sync: a row for every post, in the order they come
+    in post stats (see plan_sync). Ids are numbered from 2, just like Sheety does.
+    """
+
+    return [dict(sheet_row(post), id=row_id) for row_id, post in enumerate(post_stats.values(), start=2)]
+
+
+def plan_sync(rows: list, post_stats: dict):
+
+    """
+    This function compares rows read from a sheet with post stats and returns a SyncPlan.
+    Posts should end up in the sheet in the order they come in post stats (chronological), a row per post.
+
+    1. Rows with links that are not in post stats are deleted. So is every row whose link is already
+    in a row above it: a sync that has failed halfway may leave such duplicates behind.
+
+    2. Rows that are left take the first posts, in order: the n-th of them should hold the n-th post.
+    A row is updated if it holds anything else: changed values, or another post. Usually a row holds its own post,
+    since new posts are newer than every post in the sheet, but it may not if rows have been moved by hand.
+    Row ids are shifted to account for deleted rows above.
+
+    3. Posts that don't fit into the rows left are inserted, in order.
+
+    Whatever state an earlier sync has left the sheet in, the plan brings it to the same rows in the same order,
+    so running a sync again after a failure never adds a row twice or leaves rows out of order.
+    """
+
+    first_rows = {}
+    for row in rows:
+        first_rows.setdefault(row["postUrl"], row)
+
+    kept_rows = [row for row in rows if row["postUrl"] in post_stats and first_rows[row["postUrl"]] is row]
+    kept_ids = {row["id"] for row in kept_rows}
+
+    deleted_ids = sorted(row["id"] for row in rows if row["id"] not in kept_ids)
+
+    links = list(post_stats)
+    updates = {}
+
+    for row in kept_rows:
+        row_id = shift_row_id(row["id"], deleted_ids)
+        post_link = links[row_id - 2]
+
+        if row_changed(row, sheet_row(post_stats[post_link])):
+            updates[row_id] = post_link
+
+    return SyncPlan(deletes=deleted_ids[::-1],
+                    updates=updates,
+                    inserts=links[len(kept_rows):],
+                    skipped=len(kept_rows) - len(updates))
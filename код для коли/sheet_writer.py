@@ -0,0 +1,80 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Number of row updates kept in flight at once, unless the channel config sets its own
+WRITES_IN_FLIGHT = 4
+
+
+# =========== Now we create a class that writes rows to a sheet several at a time ===========
+class SheetWriter:
+
+    """
+    Sheety takes one row per request, so a sheet is filled by hundreds of requests. Instead of waiting for each
+    of them before sending the next one, the writer keeps up to "writes_in_flight" of them going at once.
+    The rate limiter still paces them (see rate_limiter module).
+
+    Only writes that don't depend on each other are run this way: PUTs to different rows.
+    A POST lands in the row after the last one, and a deletion shifts rows below it,
+    so they're still made one by one and in order.
+
+    Once a write fails, writes that haven't started yet are dropped, the ones in flight are waited for,
+    and the first error is raised.
+    """
+
+    def __init__(self, data_manager, writes_in_flight=WRITES_IN_FLIGHT):
+        self.data_manager = data_manager
+        self.writes_in_flight = writes_in_flight
+
+    def run(self, writes: list):
+
+        """
+        This method runs writes (functions that make a request and return a response) and returns their responses
+        in the same order.
+        """
+
+        if self.writes_in_flight <= 1:
+            return [write() for write in writes]
+
+        responses = [None] * len(writes)
+        errors = []
+        failed = threading.Event()
+
+        def run_write(index, write):
+            if failed.is_set():
+                return
+            try:
+                responses[index] = write()
+            except Exception as error:
+                errors.append(error)
+                failed.set()
+
+        with ThreadPoolExecutor(max_workers=self.writes_in_flight) as executor:
+            for index, write in enumerate(writes):
+                executor.submit(run_write, index, write)
+
+        if errors:
+            raise errors[0]
+
+        return responses
+
+    def update_rows(self, tab: str, rows: dict):
+
+        """
+        This method overwrites rows of a tab. rows maps row ids to Posts that should be written to them.
+        """
+
+        self.run([lambda row_id=row_id, post=post: self.data_manager.write_row(tab, post, row_id=row_id)
+                  for row_id, post in rows.items()])
+
+    def insert_rows(self, tab: str, posts: list):
+
+        """
+        This method appends Posts to the end of a tab, keeping their order.
+
+        Every POST lands in the row right after the one before it, so they're sent one by one, in order.
+        If one fails, the posts before it are already in their rows, and the next sync adds the rest after them.
+        """
+
+        for post in posts:
+            self.data_manager.write_row(tab, post)
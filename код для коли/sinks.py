@@ -0,0 +1,328 @@
+import abc
+import csv
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import data_manager
+from sheet_writer import WRITES_IN_FLIGHT
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# =========== Where post stats of a channel go ===========
+
+# Every channel writes its "daily" and "results" tabs to each of its sinks. The config lists them under "sinks":
+#
+#   {"type": "sheety"}                          - the channel's Google sheet, through Sheety
+#   {"type": "sqlite", "path": "stats.sqlite3"} - a local SQLite database
+#   {"type": "csv", "path": "exports"}          - a CSV file per channel and tab in a local directory
+#   {"type": "parquet", "path": "exports"}      - a Parquet file per channel and tab (needs pyarrow)
+
+DEFAULT_SINKS = [{"type": "sheety"}]
+
+# Columns of local copies
+LOCAL_FIELDS = ("channel_id", "post_url", "post_date", "post_preview", "shares_per_view", "reactions_per_view",
+                "shares_per_view_percentile", "shares_per_view_z_score",
+                "reactions_per_view_percentile", "reactions_per_view_z_score")
+
+# Columns added to SQLite copies after the first ones, mapped to their types. Older databases get them on open.
+ADDED_SQLITE_COLUMNS = {
+    "shares_per_view_percentile": "REAL",
+    "shares_per_view_z_score": "REAL",
+    "reactions_per_view_percentile": "REAL",
+    "reactions_per_view_z_score": "REAL",
+}
+
+
+def local_rows(channel_id: str, post_stats: dict):
+
+    """
+    This function turns post stats into rows of a local copy: tuples of LOCAL_FIELDS.
+    Unlike the sheet, local copies keep the full date and time of a post, and where it stands among
+    the other posts of the tab (percentile ranks and z-scores, see engagement module).
+    """
+
+    return [(channel_id, post.link, post.date.isoformat(), post.text, post.shares_per_view, post.reactions_per_view,
+             post.shares_per_view_percentile, post.shares_per_view_z_score,
+             post.reactions_per_view_percentile, post.reactions_per_view_z_score)
+            for post in post_stats.values()]
+
+
+def file_name(channel_id: str, tab: str, extension: str):
+    return f"{channel_id.replace('/', '_')}_{tab}.{extension}"
+
+
+# =========== Now we create the sinks ===========
+class Sink(abc.ABC):
+
+    """
+    A sink takes post stats of a tab ("daily" or "results") and stores them somewhere.
+    """
+
+    name = "sink"
+
+    # Tells the sink apart from other sinks of the same type, e.g. "csv: exports"
+    key = "sink"
+
+    @abc.abstractmethod
+    def write(self, tab: str, post_stats):
+
+        """
+        This method stores post stats of a tab: a dict of post links mapped to Posts, in chronological order.
+        """
+
+    def forget_state(self):
+
+        """
+        This method drops anything the sink remembers between runs about what it has stored.
+        """
+
+    def close(self):
+        pass
+
+
+class SheetySink(Sink):
+
+    """
+    The channel's Google sheet. Rows go one request at a time, so it's by far the slowest sink.
+    """
+
+    name = "sheety"
+
+    def __init__(self, channel: dict, transport=None, keep_sheet_state=False):
+        self.key = f"{self.name}: {channel['sheet']}"
+        self.data_manager = data_manager.DataManager({}, transport=transport, sheet=channel["sheet"],
+                                                     keep_sheet_state=keep_sheet_state,
+                                                     writes_in_flight=channel.get("sheety_writes_in_flight",
+                                                                                  WRITES_IN_FLIGHT))
+        self.metrics = self.data_manager.transport.metrics
+
+    def write(self, tab: str, post_stats):
+
+        self.data_manager.post_stats = post_stats
+
+        if tab == "daily":
+            with self.metrics.stage("daily sheet: first call"):
+                self.data_manager.first_call_daily_sheet()
+            with self.metrics.stage("daily sheet: update"):
+                self.data_manager.update_daily()
+        else:
+            with self.metrics.stage("results sheet: first call"):
+                self.data_manager.first_call_results_sheet()
+            with self.metrics.stage("results sheet: update"):
+                self.data_manager.update_results()
+
+    def forget_state(self):
+        self.data_manager.forget_rows("daily")
+        self.data_manager.forget_rows("results")
+
+
+class SQLiteSink(Sink):
+
+    """
+    A local SQLite database. Every write replaces the whole tab of the channel in a single transaction,
+    so readers see either the previous set of rows or the new one.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, channel: dict, path: str):
+
+        self.channel_id = channel["channel_id"]
+        self.key = f"{self.name}: {path}"
+
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS post_stats_copy (
+                tab TEXT NOT NULL,
+                channel_id TEXT NOT NULL,
+                post_url TEXT NOT NULL,
+                post_date TEXT NOT NULL,
+                post_preview TEXT,
+                shares_per_view REAL,
+                reactions_per_view REAL,
+                synced_at REAL NOT NULL,
+                shares_per_view_percentile REAL,
+                shares_per_view_z_score REAL,
+                reactions_per_view_percentile REAL,
+                reactions_per_view_z_score REAL,
+                PRIMARY KEY (tab, channel_id, post_url)
+            )
+            """
+        )
+
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(post_stats_copy)")}
+        for column, column_type in ADDED_SQLITE_COLUMNS.items():
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE post_stats_copy ADD COLUMN {column} {column_type}")
+
+        self.connection.commit()
+
+    def write(self, tab: str, post_stats):
+
+        if not post_stats:
+            return
+
+        synced_at = time.time()
+        rows = [(tab, *row, synced_at) for row in local_rows(self.channel_id, post_stats)]
+
+        # Columns are named, since databases created before rankings have them in another order
+        columns = ", ".join(("tab", *LOCAL_FIELDS, "synced_at"))
+        placeholders = ", ".join("?" * (len(LOCAL_FIELDS) + 2))
+
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM post_stats_copy WHERE tab = ? AND channel_id = ?",
+                                    (tab, self.channel_id))
+            self.connection.executemany(f"INSERT INTO post_stats_copy ({columns}) VALUES ({placeholders})", rows)
+
+    def close(self):
+        self.connection.close()
+
+
+class CSVSink(Sink):
+
+    """
+    A CSV file per channel and tab in a local directory. Every write replaces the file as a whole.
+    """
+
+    name = "csv"
+
+    def __init__(self, channel: dict, path: str):
+        self.channel_id = channel["channel_id"]
+        self.key = f"{self.name}: {path}"
+        self.directory = path
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self, tab: str, post_stats):
+
+        if not post_stats:
+            return
+
+        path = os.path.join(self.directory, file_name(self.channel_id, tab, "csv"))
+        temporary_path = f"{path}.tmp"
+
+        with open(temporary_path, "w", encoding="utf-8", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(LOCAL_FIELDS)
+            writer.writerows(local_rows(self.channel_id, post_stats))
+
+        os.replace(temporary_path, path)
+
+
+class ParquetSink(Sink):
+
+    """
+    A Parquet file per channel and tab in a local directory. Every write replaces the file as a whole.
+    """
+
+    name = "parquet"
+
+    def __init__(self, channel: dict, path: str):
+
+        if pyarrow is None:
+            raise RuntimeError("Parquet sink needs pyarrow: pip install pyarrow")
+
+        self.channel_id = channel["channel_id"]
+        self.key = f"{self.name}: {path}"
+        self.directory = path
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self, tab: str, post_stats):
+
+        if not post_stats:
+            return
+
+        columns = list(zip(*local_rows(self.channel_id, post_stats)))
+        table = pyarrow.table({field: list(column) for field, column in zip(LOCAL_FIELDS, columns)})
+
+        path = os.path.join(self.directory, file_name(self.channel_id, tab, "parquet"))
+        temporary_path = f"{path}.tmp"
+
+        pyarrow.parquet.write_table(table, temporary_path)
+        os.replace(temporary_path, path)
+
+
+SINK_TYPES = {
+    "sheety": SheetySink,
+    "sqlite": SQLiteSink,
+    "csv": CSVSink,
+    "parquet": ParquetSink,
+}
+
+
+def make_sinks(channel: dict, transport=None, keep_sheet_state=False):
+
+    """
+    This function creates every sink listed in the channel's config (DEFAULT_SINKS, if it lists none).
+    """
+
+    sinks = []
+
+    for sink_config in channel.get("sinks") or DEFAULT_SINKS:
+        if sink_config["type"] not in SINK_TYPES:
+            raise ValueError(f"Unknown sink type: {sink_config['type']}")
+
+        if sink_config["type"] == "sheety":
+            sinks.append(SheetySink(channel, transport=transport, keep_sheet_state=keep_sheet_state))
+        else:
+            sinks.append(SINK_TYPES[sink_config["type"]](channel, sink_config["path"]))
+
+    return sinks
+
+
+def sheety_sink(sinks: list):
+    for sink in sinks:
+        if isinstance(sink, SheetySink):
+            return sink
+
+
+def journal_step(tab: str, sink: Sink):
+    return f"{tab} sink: {sink.key}"
+
+
+def write_to_sinks(sinks: list, tab: str, post_stats, metrics, journal=None):
+
+    """
+    This function writes post stats of a tab to every sink at the same time, so the local copies
+    are done long before Sheety is. A failure in one sink doesn't stop the others,
+    once they're all done the first error is raised.
+
+    If a run journal is given, every sink that has been written is saved to it, and sinks a failed run
+    of the same day has already written are skipped (see run_journal module).
+    """
+
+    def write(sink):
+
+        if journal is not None and journal.has(journal_step(tab, sink)):
+            print(f"{tab} tab of {sink.key} is already written, skipping it")
+            return
+
+        with metrics.stage(f"{tab} sink: {sink.name}"):
+            sink.write(tab, post_stats)
+
+        if journal is not None:
+            journal.save(journal_step(tab, sink))
+
+    if len(sinks) == 1:
+        write(sinks[0])
+        return
+
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=len(sinks)) as executor:
+        for future in [executor.submit(write, sink) for sink in sinks]:
+            error = future.exception()
+            if error is not None:
+                errors.append(error)
+
+    if errors:
+        raise errors[0]
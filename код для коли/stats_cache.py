@@ -0,0 +1,150 @@
+import sqlite3
+import datetime as dt
+import json
+import os
+import threading
+import time
+
+
+# =========== How long post stats stay fresh, depending on how old the post is ===========
+
+# Fresh posts gain views, shares and reactions fast, so their stats are refreshed often.
+# Older posts barely move, so we can reuse their stats for much longer.
+# Each item is (max post age, TTL of its stats). Posts older than the last age use the last TTL.
+AGE_TTLS = [
+    (dt.timedelta(days=1), dt.timedelta(hours=1)),
+    (dt.timedelta(days=3), dt.timedelta(hours=6)),
+    (dt.timedelta(days=7), dt.timedelta(hours=12)),
+    (dt.timedelta(days=14), dt.timedelta(days=1)),
+    (dt.timedelta(days=31), dt.timedelta(days=3)),
+]
+OLD_POST_TTL = dt.timedelta(days=7)
+
+
+def stats_ttl(post_date: dt.datetime, now: dt.datetime):
+
+    """
+    This function returns how long stats of a post published at post_date can be reused.
+    """
+
+    post_age = now - post_date
+
+    for max_age, ttl in AGE_TTLS:
+        if post_age <= max_age:
+            return ttl
+
+    return OLD_POST_TTL
+
+
+def ratios(post_data: dict):
+
+    """
+    This function returns shares per view and reactions per view of a post, in percent, from raw TGStat data.
+    """
+
+    views_count = post_data["viewsCount"] or 1
+
+    return (post_data["sharesCount"] / views_count * 100,
+            post_data["reactionsCount"] / views_count * 100)
+
+
+def ratio_change(old_data: dict, new_data: dict):
+
+    """
+    This function returns how far the ratios of a post have moved between two fetches, in percentage points.
+    """
+
+    return sum(abs(new - old) for old, new in zip(ratios(old_data), ratios(new_data)))
+
+
+# =========== Now we create a class that keeps TGStat post stats on disk between runs ===========
+class StatsCache:
+
+    def __init__(self, path=None):
+
+        self.path = path or os.environ.get("TGSTAT_CACHE_PATH", "tgstat_cache.sqlite3")
+
+        # Stats are read and written from worker threads too, so the connection is shared under a lock
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS post_stats (
+                link TEXT PRIMARY KEY,
+                post_date REAL NOT NULL,
+                fetched_at REAL NOT NULL,
+                data TEXT NOT NULL
+            )
+            """
+        )
+        # How fast ratios of every post moved between its last two fetches, in percentage points per hour
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS post_stats_change (
+                link TEXT PRIMARY KEY,
+                change_per_hour REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+    def get_entry(self, post_link: str):
+
+        """
+        This method returns whatever the cache holds on a post, fresh or not: a tuple of when its stats were fetched
+        (unix timestamp), raw TGStat data and how fast its ratios moved between the last two fetches
+        (None if it has been fetched only once). If the post is not in the cache, it returns None.
+        """
+
+        with self._lock:
+            row = self.connection.execute(
+                """
+                SELECT fetched_at, data, change_per_hour FROM post_stats
+                LEFT JOIN post_stats_change USING (link)
+                WHERE link = ?
+                """,
+                (post_link,)).fetchone()
+
+        if row is None:
+            return
+
+        fetched_at, data, change_per_hour = row
+        return fetched_at, json.loads(data), change_per_hour
+
+    @staticmethod
+    def is_fresh(fetched_at: float, post_date: dt.datetime):
+        now = dt.datetime.now()
+        return now - dt.datetime.fromtimestamp(fetched_at) <= stats_ttl(post_date, now)
+
+    def put_many(self, posts_data: dict, posts_dates: dict, fetch_times=None):
+
+        """
+        This method saves TGStat data on several posts in one transaction.
+
+        posts_data maps post links to raw TGStat data, posts_dates maps the same links to post dates.
+        fetch_times may map some of the links to when their data was fetched (unix timestamps), the rest
+        are saved as fetched right now. If a post has been fetched before, how fast its ratios have moved
+        since then is saved too.
+        """
+
+        fetch_times = fetch_times or {}
+        now = time.time()
+        rows = [(post_link, posts_dates[post_link].timestamp(), fetch_times.get(post_link, now), json.dumps(post_data))
+                for post_link, post_data in posts_data.items()]
+
+        with self._lock, self.connection:
+            changes = []
+            for post_link, post_data in posts_data.items():
+                row = self.connection.execute("SELECT fetched_at, data FROM post_stats WHERE link = ?",
+                                              (post_link,)).fetchone()
+                if row is None:
+                    continue
+
+                hours_between_fetches = max((fetch_times.get(post_link, now) - row[0]) / 3600, 1 / 60)
+                changes.append((post_link, ratio_change(json.loads(row[1]), post_data) / hours_between_fetches))
+
+            self.connection.executemany("INSERT OR REPLACE INTO post_stats VALUES (?, ?, ?, ?)", rows)
+            self.connection.executemany("INSERT OR REPLACE INTO post_stats_change VALUES (?, ?)", changes)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,122 @@
+import functools
+import json
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import default_metrics
+from rate_limiter import default_rate_limiter, endpoint_key
+
+
+# =========== Transport settings ===========
+
+# (connect timeout, read timeout) in seconds
+TIMEOUT = (5, 30)
+
+# Max number of open connections kept per host. Requests over the limit wait for a free connection.
+CONNECTIONS_PER_HOST = 8
+
+# Connection errors and dropped reads are retried right here. 429 and 5xx responses are retried by the rate limiter,
+# since it also has to slow the endpoint down. Only GET and PUT are sent again after they have gone out:
+# a repeated POST adds a row twice, and Sheety deletes rows by their number, so a repeated DELETE removes
+# the row that has moved up into the place of the deleted one. Requests that never reached the service
+# (connection errors) are safe to repeat whatever their method.
+RETRY_POLICY = Retry(total=3,
+                     connect=3,
+                     read=2,
+                     status=0,
+                     backoff_factor=0.5,
+                     allowed_methods=frozenset({"GET", "PUT"}),
+                     raise_on_status=False)
+
+
+# =========== A response whose body is decoded only once ===========
+class Response:
+
+    def __init__(self, response: requests.Response):
+        self.raw = response
+        self.url = response.url
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.content
+
+    @functools.cached_property
+    def text(self):
+        return self.raw.text
+
+    @functools.cached_property
+    def _json(self):
+        return self.raw.json()
+
+    def json(self):
+        return self._json
+
+    def raise_for_status(self):
+        self.raw.raise_for_status()
+
+
+# =========== Now we create a class that sends every request to TGStat and Sheety ===========
+class Transport:
+
+    def __init__(self, rate_limiter=None, timeout=TIMEOUT, connections_per_host=CONNECTIONS_PER_HOST,
+                 retry_policy=RETRY_POLICY, metrics=None):
+
+        self.rate_limiter = rate_limiter if rate_limiter is not None else default_rate_limiter
+        self.metrics = metrics if metrics is not None else default_metrics
+        self.timeout = timeout
+
+        # A single session keeps connections alive, so TCP and TLS handshakes are paid once per connection,
+        # not once per request.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=connections_per_host,
+                              pool_block=True,
+                              max_retries=retry_policy)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, **kwargs):
+
+        """
+        This method sends a request through the rate limiter and returns a Response.
+        Keyword arguments are passed to requests as is. Every attempt is counted in self.metrics.
+        """
+
+        kwargs.setdefault("timeout", self.timeout)
+
+        return self.rate_limiter.call(url, lambda: self.send_counted(method, url, **kwargs), method=method)
+
+    def send_counted(self, method: str, url: str, **kwargs):
+
+        started = time.perf_counter()
+        response = self.send(method, url, **kwargs)
+
+        body = kwargs.get("json")
+        self.metrics.record_request(endpoint_key(url),
+                                    response.status_code,
+                                    len(json.dumps(body).encode("utf-8")) if body is not None else 0,
+                                    len(response.content or b""),
+                                    time.perf_counter() - started)
+
+        return response
+
+    def send(self, method: str, url: str, **kwargs):
+
+        """
+        This method makes a single request, without the rate limiter, and returns a Response.
+        Subclasses override it to record requests or serve them from a recording (see recording module).
+        """
+
+        return Response(self.session.request(method, url, **kwargs))
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+# The transport shared by StatCalculator and DataManager, unless they're given another one
+default_transport = Transport()